@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Retries with jittered exponential backoff, and limits on the rate and concurrency of calls."""
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to capacity."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available, without waiting."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Take a token, waiting until one is available."""
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PriorityLimiter:
+    """Allows limit holders at a time; waiters get in lowest priority first, then in order of arrival."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []  # heap of (priority, arrival, future)
+        self._arrivals = itertools.count()
+
+    def _wake(self):
+        while self.waiters and self.active < self.limit:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    async def acquire(self, priority=0):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Hand the slot on when it was granted just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        """Hold one of the limit slots for the with block."""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def backoff_delays(attempts, base, cap):
+    """Yield the delay before each retry: full jitter below an exponentially growing ceiling."""
+    for attempt in range(attempts - 1):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def retry(call, attempts=3, base=0.5, cap=8.0, retryable=lambda e: True):
+    """Await call() until it succeeds, fails with a non-retryable error, or attempts run out.
+
+    An error's retry_after attribute, when set, is the minimum delay
+    before the next attempt. Errors asking to wait longer than cap are
+    raised rather than waited out, as callers hold limiter slots meanwhile.
+    """
+    delays = backoff_delays(attempts, base, cap)
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            delay = next(delays, None)
+            if delay is None or not retryable(e):
+                raise
+            retry_after = getattr(e, "retry_after", None) or 0
+            if retry_after > cap:
+                logger.warning(f"Not retrying, asked to wait {retry_after:.0f}s after error: {e}")
+                raise
+            delay = max(delay, retry_after)
+            logger.warning(f"Retrying in {delay:.1f}s after error: {e}")
+            await asyncio.sleep(delay)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""A local stand-in for the NS trips API, replaying sample-trips/*.json.
+
+Every recorded response is moved in time so its first trip departs at
+the requested dateTime. Scroll contexts page forward and backward
+through copies of the recording, one recording span apart, so paging
+never runs out. Responses can be delayed and can fail at configurable
+rates. Run from the repository root, then start the app against it:
+
+    python benchmarks/fakens.py --port 8090 --latency 200
+    NS_TRIPS_URL=http://127.0.0.1:8090/trips python main.py
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+AMSTERDAM = ZoneInfo("Europe/Amsterdam")
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def _departure(trip):
+    return datetime.strptime(trip["legs"][0]["origin"]["plannedDateTime"], TIME_FORMAT)
+
+
+def _shift(value, offset):
+    """Return value with every *DateTime field moved by offset, in Amsterdam time."""
+    if isinstance(value, dict):
+        return {key: (datetime.strptime(item, TIME_FORMAT) + offset).astimezone(AMSTERDAM).strftime(TIME_FORMAT)
+                if key.endswith("DateTime") and isinstance(item, str) else _shift(item, offset)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shift(item, offset) for item in value]
+    return value
+
+
+class Recording:
+    """The recorded trips of one station pair, split in pages."""
+
+    def __init__(self, response, page_size=None):
+        trips = sorted(response["trips"], key=_departure)
+        page_size = page_size or len(trips)
+        self.source = response.get("source", "HARP")
+        self.pages = [trips[i:i + page_size] for i in range(0, len(trips), page_size)]
+        self.start = _departure(trips[0])
+        # Copies follow each other like the recorded trips do
+        first, last = self.start, _departure(trips[-1])
+        self.span = (last - first) + (last - first) / max(1, len(trips) - 1)
+
+
+class FakeNS:
+    """Serves recorded trips, counting the requests it answers."""
+
+    def __init__(self, recordings, latency=0.0, jitter=0.0, error_rate=0.0, rate_limited_rate=0.0):
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limited_rate = rate_limited_rate
+        self.calls = Counter()  # (pair, status) -> requests
+        self.pages = Counter()  # "first" or "scroll" -> successful requests
+        self.bodies = {}
+
+    @classmethod
+    def from_directory(cls, directory=os.path.join(ROOT, "sample-trips"), page_size=None, **kwargs):
+        recordings = {}
+        for path in glob.glob(os.path.join(directory, "sample-trips-*-*-None.json")):
+            origin, destination = os.path.basename(path).split("-")[2:4]
+            with open(path) as f:
+                recordings[(origin, destination)] = Recording(json.load(f), page_size)
+        return cls(recordings, **kwargs)
+
+    def body(self, pair, base, page):
+        """Return the JSON of page (any integer) of the recording moved base seconds."""
+        key = (pair, base, page)
+        if key not in self.bodies:
+            self.bodies[key] = self._render(pair, base, page)
+            if len(self.bodies) > 1024:
+                self.bodies.pop(next(iter(self.bodies)))
+        return self.bodies[key]
+
+    def _render(self, pair, base, page):
+        recording = self.recordings[pair]
+        copy, index = divmod(page, len(recording.pages))
+        offset = timedelta(seconds=base) + copy * recording.span
+        trips = []
+        for trip in recording.pages[index]:
+            trip = _shift(trip, offset)
+            # Every copy of a trip is a different trip
+            trip["uid"] = f"{trip.get('uid', '')}~{int(offset.total_seconds())}"
+            trip["checksum"] = f"{trip.get('checksum', '')}~{int(offset.total_seconds())}"
+            trips.append(trip)
+        context = f"fake|{base}|{{}}"
+        return json.dumps({
+            "source": recording.source,
+            "trips": trips,
+            "scrollRequestBackwardContext": context.format(page - 1),
+            "scrollRequestForwardContext": context.format(page + 1),
+        })
+
+    async def trips(self, request):
+        origin = request.query.get("fromStation", "").lower()
+        destination = request.query.get("toStation", "").lower()
+        pair = (origin, destination)
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        headers = {}
+        if pair not in self.recordings:
+            status, body = 400, json.dumps({"code": 400, "message": f"No recording of {origin}-{destination}"})
+        elif random.random() < self.rate_limited_rate:
+            status, body, headers = 429, json.dumps({"message": "Rate limit exceeded"}), {"Retry-After": "1"}
+        elif random.random() < self.error_rate:
+            status, body = 503, json.dumps({"message": "Service unavailable"})
+        else:
+            context = request.query.get("context", "")
+            if context.startswith("fake|"):
+                _, base, page = context.split("|")
+                base, page = int(base), int(page)
+                self.pages["scroll"] += 1
+            else:
+                requested = datetime.strptime(request.query["dateTime"], "%Y-%m-%dT%H:%M").replace(tzinfo=AMSTERDAM)
+                base, page = int((requested - self.recordings[pair].start).total_seconds()), 0
+                self.pages["first"] += 1
+            status, body = 200, self.body(pair, base, page)
+        self.calls[(f"{origin}-{destination}", status)] += 1
+        return web.Response(status=status, text=body, headers=headers, content_type="application/json")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/trips", self.trips)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Serve on host and port, returning the trips URL and the runner to clean up."""
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/trips", runner
+
+
+def add_arguments(parser):
+    """Add the options of the stand-in to an argument parser."""
+    parser.add_argument("--latency", type=float, default=100, help="response delay in ms")
+    parser.add_argument("--jitter", type=float, default=50, help="random variation of the delay in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--rate-limited-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--page-size", type=int, help="trips per page, all recorded trips by default")
+
+
+def from_arguments(args):
+    return FakeNS.from_directory(
+        page_size=args.page_size, latency=args.latency / 1000, jitter=args.jitter / 1000,
+        error_rate=args.error_rate, rate_limited_rate=args.rate_limited_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8090)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(from_arguments(args).app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Load test the app with simulated browser clients against a local NS stand-in.
+
+Starts benchmarks/fakens.py in this process and the app (main.py) as a
+subprocess with NS_TRIPS_URL pointing at it. Each client then opens
+/v3/trains/{where}/{hour} pages the way a browser does, loading the page
+and completing NiceGUI's socket.io handshake, and clicks refresh on
+them. Page latency runs from the page request, and refresh latency from
+the click, until the trip count of the page arrives. The report has
+p50/p99 latencies, the requests the stand-in answered and the resident
+memory of the app. Run from the repository root:
+
+    python benchmarks/loadtest.py --clients 50 --rounds 5 --latency 200
+
+The app is started with the environment of this script, so NS_* and
+STATIONATOR_* settings apply to it as usual.
+"""
+import argparse
+import ast
+import asyncio
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlencode
+
+import aiohttp
+import socketio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+import fakens  # noqa: E402
+
+QUERY = re.compile(r"query: (\{.*?\}),\n")
+TRIP_COUNT = re.compile(r"^\d+ trips at ")
+
+
+class Page:
+    """One open page: a socket.io connection and the elements it was sent."""
+
+    def __init__(self, base_url, http):
+        self.base_url = base_url
+        self.http = http
+        self.sio = socketio.AsyncClient(reconnection=False, http_session=http)
+        self.elements = {}
+        self.client_id = None
+        self.rendered = asyncio.Event()
+        self.sio.on("update", self.on_update)
+
+    async def open(self, path):
+        """Load path and connect to it, like a browser opening the page."""
+        async with self.http.get(self.base_url + path) as response:
+            response.raise_for_status()
+            html = await response.text()
+        query = ast.literal_eval(QUERY.search(html).group(1))
+        self.client_id = query["client_id"]
+        await self.sio.connect(f"{self.base_url}?{urlencode(query)}", transports=["websocket"],
+                               socketio_path="/_nicegui_ws/socket.io")
+        handshake = {
+            "client_id": self.client_id,
+            "document_id": str(uuid.uuid4()),
+            "tab_id": str(uuid.uuid4()),
+            "old_tab_id": None,
+            "next_message_id": query.get("next_message_id"),
+        }
+        if not await self.sio.call("handshake", handshake):
+            raise RuntimeError(f"Handshake of {path} failed")
+
+    async def on_update(self, data):
+        for element_id, element in data.items():
+            if element_id == "_id":
+                continue
+            if element is None:
+                self.elements.pop(element_id, None)
+                continue
+            self.elements[element_id] = element
+            if TRIP_COUNT.match(element.get("text", "")):
+                self.rendered.set()
+
+    async def click(self, href):
+        """Click the link to href, as the refresh link '#' of the trips pages."""
+        for element_id, element in self.elements.items():
+            if element.get("props", {}).get("href") == href:
+                for event in element.get("events", []):
+                    if event["type"] == "click":
+                        await self.sio.emit("event", {
+                            "id": int(element_id), "client_id": self.client_id,
+                            "listener_id": event["listener_id"], "args": [],
+                        })
+                        return
+        raise RuntimeError(f"No link to {href} on the page")
+
+    async def close(self):
+        await self.sio.disconnect()
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {"page": [], "refresh": []}
+        self.failures = {"page": 0, "refresh": 0}
+
+    async def timed(self, kind, action, timeout):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(action(), timeout)
+            self.latencies[kind].append(time.perf_counter() - start)
+            return True
+        except Exception as e:
+            self.failures[kind] += 1
+            print(f"{kind} failed: {type(e).__name__}: {e}", file=sys.stderr)
+            return False
+
+
+async def run_client(base_url, results, args, hours):
+    """Open a page for a random destination and hour each round, clicking refresh on it."""
+    # Each client is a browser with its own cookies, so its own user storage
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as http:
+        for _ in range(args.rounds):
+            page = Page(base_url, http)
+
+            async def open_page():
+                await page.open(f"/v3/trains/{random.choice(['home', 'work'])}/{random.choice(hours)}")
+                await page.rendered.wait()
+
+            if await results.timed("page", open_page, args.timeout):
+                for _ in range(args.refreshes):
+                    await asyncio.sleep(random.uniform(0, 2 * args.think))
+
+                    async def refresh():
+                        page.rendered.clear()
+                        await page.click("#")
+                        await page.rendered.wait()
+
+                    await results.timed("refresh", refresh, args.timeout)
+            await asyncio.sleep(random.uniform(0, 2 * args.think))
+            await page.close()
+
+
+def rss(pid):
+    """Resident memory of a process and its children in bytes, or None where /proc is not available.
+
+    The app runs in a child process of uvicorn's reloader.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            total = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                total += sum(rss(int(child)) or 0 for child in f.read().split())
+        return total
+    except (OSError, StopIteration):
+        return None
+
+
+async def sample_rss(pid, samples, interval=0.5):
+    while True:
+        value = rss(pid)
+        if value is not None:
+            samples.append(value)
+        await asyncio.sleep(interval)
+
+
+async def wait_until_up(base_url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"App exited with status {server.returncode}")
+            try:
+                async with http.get(f"{base_url}/metrics") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"App did not start within {timeout}s")
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+def report(results, fake, rss_samples, elapsed):
+    print(f"\n{'':10} {'count':>7} {'failed':>7} {'p50':>9} {'p99':>9} {'max':>9}")
+    for kind, latencies in results.latencies.items():
+        line = f"{kind:10} {len(latencies):7} {results.failures[kind]:7}"
+        if latencies:
+            line += "".join(f" {v * 1000:7.0f}ms" for v in
+                            (percentile(latencies, 50), percentile(latencies, 99), max(latencies)))
+        print(line)
+
+    calls = sum(fake.calls.values())
+    print(f"\nNS requests: {calls} in {elapsed:.0f}s ({calls / elapsed:.1f}/s), "
+          f"{fake.pages['first']} first pages and {fake.pages['scroll']} scrolled")
+    for (pair, status), count in sorted(fake.calls.items()):
+        print(f"  {pair:10} {status}: {count}")
+
+    if rss_samples:
+        mib = 1024 * 1024
+        print(f"\nApp RSS: {rss_samples[0] / mib:.0f} MiB at start, {max(rss_samples) / mib:.0f} MiB peak, "
+              f"{rss_samples[-1] / mib:.0f} MiB at end")
+    else:
+        print("\nApp RSS: not available on this platform")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=20, help="simulated browser clients")
+    parser.add_argument("--rounds", type=int, default=3, help="pages each client opens")
+    parser.add_argument("--refreshes", type=int, default=2, help="refresh clicks on each page")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds between actions of a client")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds over which clients start")
+    parser.add_argument("--hours", type=int, nargs="+",
+                        help="hours of the pages opened, this hour to three hours ahead by default")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before an action fails")
+    parser.add_argument("--port", type=int, default=8081, help="port of the app")
+    fakens.add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = fakens.from_arguments(args)
+    ns_url, ns_runner = await fake.start()
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = {
+        **os.environ,
+        "NS_TRIPS_URL": ns_url,
+        "NS_API_KEY": os.getenv("NS_API_KEY", "loadtest"),
+        "STATIONATOR_PORT": str(args.port),
+    }
+    log = tempfile.NamedTemporaryFile("w", prefix="stationator-loadtest-", suffix=".log", delete=False)
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"App log in {log.name}")
+
+    rss_samples = []
+    sampler = None
+    try:
+        await wait_until_up(base_url, server)
+        sampler = asyncio.create_task(sample_rss(server.pid, rss_samples))
+        hour = int(time.strftime("%H"))
+        hours = args.hours or [(hour + offset) % 24 for offset in range(4)]
+
+        results = Results()
+        start = time.perf_counter()
+
+        async def client(i):
+            await asyncio.sleep(args.ramp_up * i / args.clients)
+            await run_client(base_url, results, args, hours)
+
+        await asyncio.gather(*(client(i) for i in range(args.clients)))
+        report(results, fake, rss_samples, time.perf_counter() - start)
+    finally:
+        if sampler:
+            sampler.cancel()
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        await ns_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Compare ways of parsing NS trips responses.
+
+Uses the recorded responses in sample-trips.json.gz. Run from the
+repository root:
+
+    python benchmarks/parse.py
+"""
+import gzip
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import ns  # noqa: E402
+
+
+def load_bodies(path="sample-trips.json.gz"):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        sample_data = json.load(f)
+    return [json.dumps(page).encode() for page in sample_data.values()]
+
+
+def main():
+    bodies = load_bodies()
+    size = sum(len(b) for b in bodies)
+    print(f"{len(bodies)} responses, {size / 1024:.0f} KiB")
+
+    candidates = {
+        "json.loads (full payload)": lambda: [json.loads(b) for b in bodies],
+        "ns.parse_trips_response": lambda: [ns.parse_trips_response(b) for b in bodies],
+    }
+    for name, candidate in candidates.items():
+        best = min(timeit.repeat(candidate, number=10, repeat=5)) / 10
+        print(f"{name:30} {best * 1000:8.2f} ms")
+
+    full = len(json.dumps([json.loads(b) for b in bodies]))
+    compact = len(json.dumps([ns.parse_trips_response(b) for b in bodies]))
+    print(f"retained JSON size: {full / 1024:.0f} KiB -> {compact / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
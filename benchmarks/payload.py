@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Measure the element payload NiceGUI sends to the browser for a page.
+
+Renders pages in NiceGUI's user simulation, with trips served from
+sample-trips.json.gz instead of the NS API, and reports the number of
+elements, the size of their serialized state and the time until the
+page stops changing. --scale repeats every sample trip to see how pages
+grow with the trip count. A path given twice is opened by two clients
+in turn. Run from the repository root:
+
+    python benchmarks/payload.py [--scale N] [/v3/trains/work/8 ...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import runpy
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ["NICEGUI_USER_SIMULATION"] = "true"
+
+import httpx  # noqa: E402
+from nicegui import core  # noqa: E402
+from nicegui.testing.user import User  # noqa: E402
+
+from samples import use_sample_trips  # noqa: E402
+
+
+def payload_size(client):
+    """Return (element count, bytes of serialized element state) for a client."""
+    elements = list(client.elements.values())
+    size = sum(len(json.dumps(e._to_dict(), default=str, separators=(",", ":"))) for e in elements)
+    return len(elements), size
+
+
+async def settle(client, interval=0.05, rounds=5):
+    """Wait until the client's elements stop changing, returning when they last changed."""
+    last_change, count, stable = time.perf_counter(), len(client.elements), 0
+    while stable < rounds:
+        await asyncio.sleep(interval)
+        if len(client.elements) == count:
+            stable += 1
+        else:
+            last_change, count, stable = time.perf_counter(), len(client.elements), 0
+    return last_change
+
+
+async def measure(paths, scale=1):
+    os.chdir(ROOT)
+    use_sample_trips(scale=scale)
+    runpy.run_path(os.path.join(ROOT, "main.py"), run_name="__main__")
+    results = []
+    async with core.app.router.lifespan_context(core.app):
+        for path in paths:
+            transport = httpx.ASGITransport(core.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http_client:
+                user = User(http_client)
+                start = time.perf_counter()
+                await user.open(path)
+                elapsed = await settle(user.client) - start
+                results.append((path, *payload_size(user.client), elapsed))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1, help="repeat every sample trip this many times")
+    parser.add_argument("paths", nargs="*", default=["/v3/trains/work/8", "/v3/trains/home/17"])
+    args = parser.parse_args()
+    for path, count, size, elapsed in asyncio.run(measure(args.paths, args.scale)):
+        print(f"{path:24} {count:6d} elements {size / 1024:10.1f} KiB {elapsed * 1000:8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Recorded NS responses used by the benchmarks."""
+import gzip
+import json
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SAMPLE_TRIPS = os.path.join(ROOT, "sample-trips.json.gz")
+
+
+def load_responses(path=SAMPLE_TRIPS):
+    """Return {"origin-destination": response} as recorded from the NS API."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def scale_trips(trips, scale):
+    """Repeat trips scale times, giving every copy its own uid."""
+    return [dict(t, uid=f"{t['uid']}~{i}") if i else t for i in range(scale) for t in trips]
+
+
+def load_pages(scale=1, path=SAMPLE_TRIPS):
+    """Return {"origin-destination": compact trips}, as fetch_trips returns them, repeated scale times."""
+    import ns
+
+    return {key: scale_trips([ns.compact_trip(t) for t in response["trips"]], scale)
+            for key, response in load_responses(path).items()}
+
+
+def use_sample_trips(scale=1, path=SAMPLE_TRIPS):
+    """Serve every ns.fetch_trips call from the sample responses."""
+    import ns
+
+    pages = load_pages(scale, path)
+
+    async def fetch_trips(origin, destination, date_time=None, window=None):
+        return pages.get(f"{origin}-{destination}", [])
+
+    ns.fetch_trips = fetch_trips
+    return pages
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of parsing, trip table assembly and page rendering.
+
+Uses the recorded responses in sample-trips.json.gz, replicated --scale
+times (1, 10 and 100 by default) with a distinct uid per copy. Every
+case is timed with timeit over --repeat runs of at least 0.2s each; the
+median is reported with the spread between the fastest and the median
+run, and compared to the stored baseline. Cases slower than the baseline by more than
+--tolerance are flagged and make the suite exit with status 1. Run from
+the repository root:
+
+    python benchmarks/suite.py [--scale 1 10 100] [--save]
+
+Timings depend on the machine: save a new baseline with --save when
+switching machines, and compare on the machine the baseline came from.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+import ns  # noqa: E402
+import v1  # noqa: E402
+import v2  # noqa: E402
+from gantt import Gantt  # noqa: E402
+
+from samples import SAMPLE_TRIPS, load_pages, load_responses  # noqa: E402
+
+
+def trip_table(pages, where_to):
+    """Build the trip table of where_to from pages, as on a cold start."""
+    async def fetch_trips(origin, destination, date_time=None, window=None):
+        return pages.get(f"{origin}-{destination}", [])
+
+    ns.fetch_trips = fetch_trips
+    ns._trip_tables.clear()
+    ns._parsed_trips.clear()
+    return asyncio.run(ns.get_trip_table(where_to))
+
+
+def cases(scale):
+    """Return {name: function} for the sample data replicated scale times."""
+    pages = load_pages(scale)
+    trip_data = [t for page in pages.values() for t in page if t["transfers"] == 0]
+    table = trip_table(pages, "home")
+    trips = table.trips
+    selection = {code: code in ("asdz", "laa") for code in ns.stations}
+
+    benchmarks = {
+        "Trip construction": lambda: [ns.Trip(t) for t in trip_data],
+        "get_trip_table home": lambda: trip_table(pages, "home"),
+        "get_trip_table work": lambda: trip_table(pages, "work"),
+        "v1 serialize": lambda: v1.serialize(trips),
+        "v2 card_html": lambda: [v2.card_html(t) for t in trips],
+        "v3 Gantt.chart": lambda: Gantt.chart(table.select(selection, order="arrival")),
+    }
+    if scale == 1:
+        # Decoding the full responses, compact_trip included, is the same
+        # work at any scale, so it is only timed once
+        with gzip.open(SAMPLE_TRIPS, "rb") as f:
+            raw = f.read()
+        bodies = [json.dumps(response).encode() for response in load_responses().values()]
+        benchmarks = {
+            "json decode sample": lambda: json.loads(raw),
+            "parse_trips_response": lambda: [ns.parse_trips_response(b) for b in bodies],
+            **benchmarks,
+        }
+    return benchmarks
+
+
+def measure(function, repeat):
+    """Return (median, spread) of the seconds per call over repeat runs of at least 0.2s each."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    runs = sorted(t / number for t in timer.repeat(number=number, repeat=repeat))
+    median = statistics.median(runs)
+    return median, median - runs[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=int, nargs="+", default=[1, 10, 100],
+                        help="times the sample trips are replicated")
+    parser.add_argument("--repeat", type=int, default=7, help="timed runs per case")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown over the baseline flagged as a regression")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--filter", help="only run cases containing this text")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    # get_trip_table logs every build, which would dominate the timings
+    logging.disable(logging.INFO)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'case':36} {'median':>10} {'spread':>9} {'baseline':>10} {'change':>8}")
+    for scale in args.scale:
+        for name, function in cases(scale).items():
+            key = f"{name} x{scale}"
+            if args.filter and args.filter not in key:
+                continue
+            median, spread = measure(function, args.repeat)
+            results[key] = median
+            line = f"{key:36} {median * 1000:8.2f}ms {spread * 1000:7.2f}ms"
+            if key in baseline:
+                change = median / baseline[key] - 1
+                line += f" {baseline[key] * 1000:8.2f}ms {change:+7.0%}"
+                if change > args.tolerance:
+                    regressions.append(key)
+                    line += "  REGRESSION"
+            print(line, flush=True)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"Saved {len(results)} results to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    print(f"Done in {time.perf_counter() - start:.0f}s")
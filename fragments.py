@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Rendered page fragments shared by every client viewing the same trips."""
+import logging
+import os
+import metrics
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentCache:
+    """Least recently used cache of rendered fragments.
+
+    Keys are (view, where, date_time, selection, version) tuples: a new
+    trip table version makes new keys, and fragments of old versions are
+    evicted as the cache fills up. Fragments must only hold what depends
+    on those; anything that moves with the clock is computed per client.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def get(self, key, render):
+        """Return the fragment for key, calling render() to build it if missing."""
+        if key in self.fragments:
+            self.hits += 1
+            metrics.cache_hits.inc(cache="fragments")
+            self.fragments.move_to_end(key)
+            return self.fragments[key]
+        self.misses += 1
+        metrics.cache_misses.inc(cache="fragments")
+        fragment = self.fragments[key] = render()
+        if len(self.fragments) > self.maxsize:
+            self.fragments.popitem(last=False)
+            self.evictions += 1
+            metrics.cache_evictions.inc(cache="fragments")
+        return fragment
+
+    def clear(self):
+        self.fragments.clear()
+
+
+def selection_key(station_selection):
+    """Hashable form of a station selection, as kept in user storage."""
+    if station_selection is None:
+        return None
+    return tuple(sorted(code for code, selected in station_selection.items() if selected))
+
+
+default_cache = FragmentCache(int(os.getenv("STATIONATOR_FRAGMENT_CACHE_SIZE", "64")))
+
+
+def get(view, where, date_time, station_selection, trips, render):
+    """Return the fragment of a view for a trip table, rendering it on the first request."""
+    key = (view, where, date_time, selection_key(station_selection), trips.version)
+    return default_cache.get(key, render)
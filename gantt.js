@@ -0,0 +1,183 @@
+// Gantt chart of trips, see gantt.py for the row format
+const clock = new Intl.DateTimeFormat("nl-NL", {
+  timeZone: "Europe/Amsterdam",
+  hour: "2-digit",
+  minute: "2-digit",
+  hourCycle: "h23",
+});
+
+const STATUS_CLASSES = {
+  NORMAL: "text-green-600 font-semibold",
+  CANCELLED: "text-red-600 font-semibold",
+  DELAYED: "text-yellow-600 font-semibold",
+};
+
+const TIME_LABEL =
+  "position: absolute; top: -18px; font-size: 9px; color: #333; font-weight: bold; white-space: nowrap; " +
+  "background-color: rgba(255,255,255,0.9); padding: 0 2px; display: inline-flex; align-items: center; gap: 3px;";
+const TRAIN_LABEL =
+  "position: absolute; font-size: 9px; color: white; font-weight: bold; white-space: nowrap; " +
+  "text-shadow: 1px 1px 2px rgba(0,0,0,0.5);";
+
+function pad(n) {
+  return String(n).padStart(2, "0");
+}
+
+export default {
+  template: `
+    <div class="nicegui-column w-full max-w-6xl overflow-x-hidden">
+      <div v-if="!trips.length" class="text-lg text-gray-500 mt-4">No trips available</div>
+      <div v-for="trip in trips" :key="trip.id" :id="trip.id" @click="select(trip.id)"
+           :class="['nicegui-row w-full mb-1 items-center cursor-pointer transition-all', trip.id === selected ? selectedClasses : '']">
+        <div class="nicegui-row w-[320px] flex-shrink-0 pr-2 items-center gap-1 sm:gap-2 flex-nowrap">
+          <div class="text-[10px] sm:text-xs font-bold whitespace-nowrap">{{ trip.origin.toUpperCase() }} → {{ trip.destination.toUpperCase() }}</div>
+          <div :class="['text-[10px] sm:text-xs whitespace-nowrap', statusClasses[trip.status] || 'text-gray-600']">{{ trip.status }}</div>
+          <div v-if="trip.direction" class="text-[10px] sm:text-xs text-gray-600 whitespace-nowrap">{{ trip.direction }}</div>
+          <div v-if="trip.track" class="text-[10px] sm:text-xs text-gray-500 whitespace-nowrap">{{ trip.track }}</div>
+          <div class="text-[10px] sm:text-xs text-gray-500 whitespace-nowrap">{{ duration(trip.arriveBy - trip.leaveBy) }}</div>
+          <div :class="['text-[10px] sm:text-xs whitespace-nowrap ml-auto', minutesClass(trip)]">{{ minutesToGo(trip) }}</div>
+        </div>
+        <div :style="{ width: scale.width + 'px', position: 'relative' }">
+          <div class="gantt-box" :style="{ position: 'relative', width: '100%', height: '35px', backgroundColor: '#ffffff',
+                                           border: (trip.id === selected ? 3 : 1) + 'px solid #003082', overflow: 'visible' }">
+            <div v-if="nowPercent !== null" title="Now" :style="{ left: nowPercent + '%' }"
+                 style="position: absolute; top: 0; width: 2px; height: 100%; background-color: #f44336; z-index: 10;"></div>
+            <div :style="timeLabel + 'left: ' + percent(trip.leaveBy) + '%;'">
+              <span style="display: inline-block; line-height: 1;" v-html="icons[0]"></span>
+              <span>{{ time(trip.leaveBy) }}</span>
+            </div>
+            <div :style="timeLabel + 'left: ' + percent(trip.arriveBy) + '%; transform: translateX(-100%);'">
+              <span style="display: inline-block; line-height: 1;" v-html="icons[1]"></span>
+              <span>{{ time(trip.arriveBy) }}</span>
+            </div>
+            <div :style="{ left: percent(trip.leaveBy) + '%', width: percent(trip.arriveBy) - percent(trip.leaveBy) + '%' }"
+                 style="position: absolute; height: 100%; display: flex; border-radius: 3px; overflow: visible;">
+              <div :style="{ width: segment(trip, trip.leaveBy, trip.departure) + '%' }"
+                   style="background-color: #FFC917; border-right: 1px solid #E6B815; position: relative;" title="Biking to station"></div>
+              <div :style="{ width: segment(trip, trip.departure, trip.arrival) + '%' }"
+                   style="position: relative; background-color: #003082; border-right: 1px solid #002366;" title="Train time">
+                <div :style="trainLabel + 'left: 2px; top: 2px;'">{{ time(trip.departure) }}</div>
+                <div :style="trainLabel + 'right: 2px; bottom: 2px;'">{{ time(trip.arrival) }}</div>
+              </div>
+              <div :style="{ width: segment(trip, trip.arrival, trip.arriveBy) + '%' }"
+                   style="background-color: #FFC917; position: relative;" title="Biking from station"></div>
+            </div>
+          </div>
+        </div>
+      </div>
+    </div>
+  `,
+  props: {
+    rows: Array,
+    strings: Array,
+    start: Number,
+    icons: Array,
+    biking: Object,
+    selectedClasses: String,
+  },
+  data() {
+    return {
+      table: this.rows.slice(),
+      names: this.strings.slice(),
+      now: Date.now() / 1000,
+      selected: null,
+      statusClasses: STATUS_CLASSES,
+      timeLabel: TIME_LABEL,
+      trainLabel: TRAIN_LABEL,
+    };
+  },
+  computed: {
+    trips() {
+      return this.table.map((row) => {
+        const [origin, destination, status, direction, track] = row.slice(0, 5).map((i) => this.names[i]);
+        const [leaveBy, departure, arrival, arriveBy] = row.slice(5).map((t) => t + this.start);
+        const id = `trip-${origin}-${destination}-${this.time(departure).replace(":", "")}`;
+        return { id, origin, destination, status, direction, track, leaveBy, departure, arrival, arriveBy };
+      });
+    },
+    scale() {
+      const min = Math.min(...this.trips.map((t) => t.leaveBy));
+      const max = Math.max(...this.trips.map((t) => t.arriveBy));
+      // 2px per second, minimum 800px
+      return { min, max, duration: max - min, width: Math.max(800, (max - min) * 2) };
+    },
+    nowPercent() {
+      if (this.now < this.scale.min || this.now > this.scale.max) return null;
+      return this.percent(this.now);
+    },
+  },
+  watch: {
+    rows(rows) {
+      this.table = rows.slice();
+      // Rows arrive after mounting when the trips were not cached yet;
+      // select the trip linked to once they are in
+      if (this.selected === null) this.$nextTick(() => this.selectFromHash());
+    },
+    strings(strings) {
+      this.names = strings.slice();
+    },
+  },
+  mounted() {
+    // The now-line and minutes to go move with the clock, not with the data
+    this.timer = setInterval(() => (this.now = Date.now() / 1000), 30000);
+    this.selectFromHash();
+  },
+  unmounted() {
+    clearInterval(this.timer);
+  },
+  methods: {
+    updateRows(changed, strings) {
+      this.names.push(...strings);
+      for (const [i, row] of changed) this.table.splice(i, 1, row);
+    },
+    selectFromHash() {
+      const hash = window.location.hash.substring(1);
+      if (hash && this.trips.some((t) => t.id === hash)) {
+        this.selected = hash;
+        this.$nextTick(() => this.scrollTo(hash));
+      }
+    },
+    select(id) {
+      if (this.selected === id) {
+        this.selected = null;
+        history.replaceState(null, "", window.location.pathname);
+      } else {
+        this.selected = id;
+        history.replaceState(null, "", window.location.pathname + "#" + id);
+        this.scrollTo(id);
+      }
+    },
+    scrollTo(id) {
+      document.getElementById(id)?.scrollIntoView({ behavior: "smooth", block: "center" });
+    },
+    percent(t) {
+      return this.scale.duration > 0 ? ((t - this.scale.min) / this.scale.duration) * 100 : 0;
+    },
+    segment(trip, from, to) {
+      const total = trip.arriveBy - trip.leaveBy;
+      return total > 0 ? ((to - from) / total) * 100 : 0;
+    },
+    time(t) {
+      return clock.format(new Date(t * 1000));
+    },
+    duration(seconds) {
+      const minutes = Math.floor(seconds / 60);
+      return `${pad(Math.floor(minutes / 60))}:${pad(minutes % 60)}`;
+    },
+    minutesUntil(trip) {
+      return Math.trunc((trip.departure - this.now) / 60);
+    },
+    minutesToGo(trip) {
+      // '-' for departures still to come, '+' for past ones
+      const minutes = this.minutesUntil(trip);
+      const abs = Math.abs(minutes);
+      const formatted = abs >= 60 ? `${Math.floor(abs / 60)}h ${pad(abs % 60)}m` : `${abs}m`;
+      return (minutes >= 0 ? "-" : "+") + formatted;
+    },
+    minutesClass(trip) {
+      const minutes = this.minutesUntil(trip);
+      if (minutes < 0) return "text-gray-500";
+      return minutes >= (this.biking[trip.origin] ?? 15) ? "text-green-600 font-semibold" : "text-red-600 font-semibold";
+    },
+  },
+};
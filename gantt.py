@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Gantt chart of trips, drawn in the browser."""
+from nicegui import ui
+import ns
+
+
+class Gantt(ui.element, component='gantt.js'):
+    """Gantt chart of trips, drawn client-side from compact rows.
+
+    Each trip is sent as a short list of numbers: string indexes for its
+    stations, status, direction and track, and its leave_by, departure,
+    arrival and arrive_by times as seconds since the start of the chart.
+    The browser draws the bars, the now-line and the minutes to go, and
+    handles selection, so the server neither formats nor resends HTML.
+    """
+
+    def __init__(self, leave_icon: str, arrive_icon: str, selected_classes: str = ''):
+        super().__init__()
+        self._props['icons'] = [leave_icon, arrive_icon]
+        self._props['selectedClasses'] = selected_classes
+        self._props['biking'] = {code: int(s.biking_time.total_seconds() // 60) for code, s in ns.stations.items()}
+        self._props['start'] = 0
+        self._props['strings'] = []
+        self._props['rows'] = []
+        self.uids = []
+
+    @staticmethod
+    def _row(trip, start, strings):
+        def index(value):
+            return strings.setdefault(value or '', len(strings))
+
+        return [
+            index(trip.origin),
+            index(trip.destination),
+            index(trip.status),
+            index(trip.direction),
+            index(trip.departure_track),
+            int(trip.leave_by.timestamp()) - start,
+            int(trip.departure_time.timestamp()) - start,
+            int(trip.arrival_time.timestamp()) - start,
+            int(trip.arrive_by.timestamp()) - start,
+        ]
+
+    @classmethod
+    def chart(cls, trips):
+        """Return the rows of the given trips and what they refer to, as sent to the browser."""
+        start = min((int(t.leave_by.timestamp()) for t in trips), default=0)
+        strings = {}
+        rows = [cls._row(t, start, strings) for t in trips]
+        return {'start': start, 'strings': list(strings), 'rows': rows, 'uids': [t.uid for t in trips]}
+
+    def set_chart(self, chart):
+        """Replace the chart with one built by Gantt.chart, which may be shared with other clients."""
+        # Copied, since update_trips changes these lists in place
+        self._props['rows'] = list(chart['rows'])
+        self._props['strings'] = list(chart['strings'])
+        self._props['start'] = chart['start']
+        self.uids = chart['uids']
+        self.update()
+
+    def set_trips(self, trips):
+        """Replace the chart with the given trips, drawn in order."""
+        self.set_chart(self.chart(trips))
+
+    def update_trips(self, trips):
+        """Redraw trips already on the chart, sending only their rows."""
+        strings = {s: i for i, s in enumerate(self._props['strings'])}
+        known = len(strings)
+        changed = []
+        for trip in trips:
+            i = self.uids.index(trip.uid)
+            self._props['rows'][i] = self._row(trip, self._props['start'], strings)
+            changed.append([i, self._props['rows'][i]])
+        added = list(strings)[known:]
+        self._props['strings'].extend(added)
+        if changed:
+            self.run_method('updateRows', changed, added)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Publish/subscribe hub pushing trip table changes to open pages."""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import ns
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A client's interest in the trips of one page, keyed by (where, date_time).
+
+    Changes are delivered at most once per min_interval seconds; changes
+    arriving in between are merged and delivered together.
+    """
+
+    def __init__(self, hub, key, callback, min_interval, refs=None):
+        self.hub = hub
+        # Token of the page's station pairs in ns.pair_refs
+        self.refs = refs
+        self.key = key
+        self.callback = callback
+        self.min_interval = min_interval
+        self.last_delivery = 0
+        self.pending = None
+        self.table = None
+        self.timer = None
+
+    def deliver(self, table, changes):
+        if self.pending is None:
+            self.pending = ns.ChangeSet(changes.version)
+        self.pending = merge_changes(self.pending, changes)
+
+        # Deliver from the event loop in an empty context rather than in the
+        # context of whichever caller built the table, which may be another
+        # page's request; callbacks must not rely on a request of their own
+        if self.timer is None:
+            wait = max(0, self.last_delivery + self.min_interval - time.monotonic())
+            self.timer = asyncio.get_running_loop().call_later(wait, self._flush, table,
+                                                               context=contextvars.Context())
+        else:
+            self.table = table
+
+    def _flush(self, table):
+        self.timer = None
+        table, self.table = self.table or table, None
+        changes, self.pending = self.pending, None
+        if not changes:
+            return
+        self.last_delivery = time.monotonic()
+        try:
+            result = self.callback(table, changes)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        except Exception as e:
+            # Typically the page's client is gone; stop pushing to it
+            logger.warning(f"Failed to push trip changes for {self.key}, unsubscribing: {e}")
+            self.hub.unsubscribe(self)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def merge_changes(older, newer):
+    """Combine two consecutive change sets into one."""
+    added = [uid for uid in older.added if uid not in newer.removed]
+    removed = [uid for uid in older.removed if uid not in newer.added]
+    updated = [uid for uid in older.updated if uid not in newer.removed]
+    # A trip removed and added back is an update of it
+    updated += [uid for uid in newer.added if uid in older.removed]
+    added += [uid for uid in newer.added if uid not in older.removed and uid not in added]
+    removed += [uid for uid in newer.removed if uid not in older.added and uid not in removed]
+    updated += [uid for uid in newer.updated if uid not in added and uid not in updated]
+    return ns.ChangeSet(newer.version, added, removed, updated)
+
+
+class Hub:
+    """Keeps subscriptions by (where, date_time) and pushes trip table changes to them."""
+
+    def __init__(self):
+        self.subscriptions = {}
+        # Version of the table last published per key
+        self.versions = {}
+        ns.table_listeners.append(self.on_table)
+
+    def subscribe(self, where, date_time, callback, version=0, min_interval=30, station_selection=None):
+        """Call callback(table, changes) when the trips for (where, date_time) change after version.
+
+        The pairs of station_selection, or all pairs of where without one,
+        are kept fetched for the subscriber until it unsubscribes.
+        """
+        key = (where, date_time)
+        subscription = Subscription(self, key, callback, min_interval, ns.pair_refs.add(where, station_selection))
+        self.subscriptions.setdefault(key, set()).add(subscription)
+        self.versions[key] = max(self.versions.get(key, 0), version)
+        logger.info(f"Subscribed to {key}, {len(self.subscriptions[key])} subscribers")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.cancel()
+        ns.pair_refs.remove(subscription.refs)
+        subscribers = self.subscriptions.get(subscription.key, set())
+        subscribers.discard(subscription)
+        if not subscribers:
+            self.subscriptions.pop(subscription.key, None)
+            self.versions.pop(subscription.key, None)
+        logger.info(f"Unsubscribed from {subscription.key}")
+
+    def on_table(self, where, date_time, table):
+        if (where, date_time) in self.subscriptions:
+            self.publish((where, date_time), table)
+
+    def publish(self, key, table):
+        """Push the changes of a new table version to the subscribers of key."""
+        if table.version <= self.versions.get(key, 0) or not table.changes:
+            return
+        self.versions[key] = table.version
+        for subscription in list(self.subscriptions.get(key, ())):
+            subscription.deliver(table, table.changes)
+
+    async def refresh(self):
+        """Look up the trips of every subscribed page, publishing what changed.
+
+        Lookups go through the cache, so this costs no API calls unless an
+        entry is stale, in which case it is revalidated in the background
+        and published on a later refresh. Only pairs some open page shows
+        are looked up, behind the fetches of pages being opened.
+        """
+        for where, date_time in list(self.subscriptions):
+            try:
+                await ns.get_trip_table(where, date_time, station_selection={})
+            except Exception as e:
+                logger.error(f"Failed to refresh trips for {where} at {date_time}: {e}")
+
+
+default_hub = Hub()
+
+
+def subscribe(where, date_time, callback, version=0, min_interval=None, station_selection=None):
+    """Subscribe callback(table, changes) to trip changes for a page on the default hub."""
+    if min_interval is None:
+        min_interval = float(os.getenv("STATIONATOR_PUSH_INTERVAL", "30"))
+    return default_hub.subscribe(where, date_time, callback, version, min_interval, station_selection)
+
+
+def unsubscribe(subscription):
+    default_hub.unsubscribe(subscription)
+
+
+async def refresh():
+    await default_hub.refresh()
@@ -1,15 +1,37 @@
 #!/usr/bin/env python3
-from datetime import timedelta
-from nicegui import ui, app
-import ns
-import asyncio
-import storage
-import icons
-
-# import is necessary to make pages work
-import v1
-import v2
-import v3
+# Imported first, so it times the imports below
+import startup
+
+with startup.timed("import nicegui"):
+    from fastapi.responses import PlainTextResponse
+    from nicegui import ui, app, Client
+with startup.timed("import modules"):
+    import ns
+    import asyncio
+    import hmac
+    import os
+    import storage
+    import icons
+    import hub
+    import prefetch
+    import metrics
+    import profiling
+
+# Views served, newest last. Each is imported, registering its pages, on
+# the first request for one of them, so starting does not wait for them
+VIEWS = [view.strip() for view in os.getenv("STATIONATOR_VIEWS", "v1,v2,v3").split(",") if view.strip()]
+
+
+@app.middleware("http")
+async def load_views(request, call_next):
+    """Import the view a request is for before it is routed."""
+    view = request.url.path.split("/")[1]
+    if view in VIEWS:
+        startup.load_view(view)
+    response = await call_next(request)
+    if response.headers.get("content-type", "").startswith("text/html"):
+        startup.page_served(request.url.path)
+    return response
 
 
 @ui.page("/")
@@ -25,15 +47,10 @@ async def trains_index():
         ui.html(icons.ns_icon('home', 24), sanitize=False)
     with ui.link("", "trains/work").classes('no-underline'):
         ui.html(icons.ns_icon('work', 24), sanitize=False)
-    with ui.link("", "/v3/trains"):
-        ui.html(icons.ns_icon('v3', 20), sanitize=False)
-        ui.label("v3")
-    with ui.link("", "/v2/trains"):
-        ui.html(icons.ns_icon('v2', 20), sanitize=False)
-        ui.label("v2")
-    with ui.link("", "/v1/trains"):
-        ui.html(icons.ns_icon('v1', 20), sanitize=False)
-        ui.label("v1")
+    for view in reversed(VIEWS):
+        with ui.link("", f"/{view}/trains"):
+            ui.html(icons.ns_icon(view, 20), sanitize=False)
+            ui.label(view)
 
 
 @ui.page("/trains/{where}")
@@ -46,35 +63,66 @@ async def trains_where(where: str):
 @ui.page("/trains/{where}/{hour}")
 async def trains_where_hour(where: str, hour: int):
     storage.init_storage()
-    # Redirect to v3 implementation
-    ui.navigate.to(f"/v3/trains/{where}/{hour}")
+    # Redirect to the newest view
+    ui.navigate.to(f"/{VIEWS[-1]}/trains/{where}/{hour}")
 
 
-async def get_trips():
-    hour = int(ns.get_amsterdam_time().hour)
-    date_time = ns.get_amsterdam_time(hour)
-    ns.fetch_trips.cache_clear()
+connected_clients = metrics.Gauge(
+    "stationator_connected_clients", "Clients with an open websocket connection",
+    function=lambda: sum(1 for client in Client.instances.values() if client.has_socket_connection))
+
 
-    #cache trips home now, and +1 -1 hour
-    await ns.get_trips(where_to="home", date_time=date_time)
-    await ns.get_trips(where_to="home", date_time=date_time + timedelta(hours=1))
+@app.get("/metrics")
+def get_metrics():
+    """Expose performance metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    #cache trips work now, and +1 -1 hour
-    await ns.get_trips(where_to="work", date_time=date_time)
-    await ns.get_trips(where_to="work", date_time=date_time + timedelta(hours=1))
+
+@app.get("/admin/profiling")
+def set_profiling(enable: bool, token: str = ""):
+    """Turn profiling on or off; requires STATIONATOR_ADMIN_TOKEN to be set and given."""
+    admin_token = os.getenv("STATIONATOR_ADMIN_TOKEN")
+    if not admin_token or not hmac.compare_digest(token, admin_token):
+        return PlainTextResponse("Forbidden", status_code=403)
+    profiling.default_profiler.enabled = enable
+    return {"enabled": enable, "directory": profiling.default_profiler.directory}
 
 
 @app.on_startup
-async def startup():
+async def start():
     """Set up background tasks on app startup."""
+    with startup.timed("open NS session"):
+        await ns.open_session()
+
     async def periodic_trips():
-        """Periodically fetch trips every 5 minutes."""
+        """Warm the pages people request around this time, less often at night and on weekends."""
         while True:
-            await get_trips()
-            await asyncio.sleep(300)  # 5 minutes
+            with metrics.refresh_seconds.time(task="prefetch"):
+                async with profiling.profile("periodic_trips"):
+                    await prefetch.run_once()
+            await asyncio.sleep(prefetch.next_run())
+
+    async def periodic_push():
+        """Push trip changes to open pages every minute."""
+        while True:
+            await asyncio.sleep(60)
+            with metrics.refresh_seconds.time(task="push"):
+                await hub.refresh()
 
     asyncio.create_task(periodic_trips())
+    asyncio.create_task(periodic_push())
+    startup.report("Started")
+
+
+@app.on_shutdown
+async def shutdown():
+    """Release the shared NS API session and cache store on app shutdown."""
+    await ns.close_session()
+    if ns.trips_store:
+        ns.trips_store.close()
 
 
 if __name__ in {"__main__", "__mp_main__"}:
-    ui.run(host="0.0.0.0", favicon="🚂", title="Stationator", show=False, storage_secret="stationator_secret_key")
+    # Reloading on code changes imports everything twice: in the watching process and in the app
+    ui.run(host="0.0.0.0", port=int(os.getenv("STATIONATOR_PORT", "8080")), favicon="🚂", title="Stationator", show=False,
+           storage_secret="stationator_secret_key", reload=os.getenv("STATIONATOR_RELOAD", "1") == "1")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Counters, gauges and histograms exposed in the Prometheus text format."""
+import math
+import time
+from contextlib import contextmanager
+
+# Default Prometheus buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with one value per combination of label values."""
+
+    type = "untyped"
+
+    def __init__(self, name, help, register=True):
+        self.name = name
+        self.help = help
+        self.values = {}  # sorted ((label, value), ...) -> value
+        if register:
+            registry.append(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """Yield (name, labels, value) for every sample of the metric."""
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, optionally read from a function when rendered."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, function=None, register=True):
+        super().__init__(name, help, register)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, (), self.function()
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, help, register)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key + (("le", _format_value(bound)),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, counts[-1]
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+fetch_seconds = Histogram(
+    "stationator_fetch_seconds", "Seconds to fetch a page of NS trips, retries included, by station pair and page")
+fetch_errors = Counter(
+    "stationator_fetch_errors_total", "Failed NS trips requests by station pair and error")
+cache_hits = Counter("stationator_cache_hits_total", "Cache lookups answered from the cache")
+cache_misses = Counter("stationator_cache_misses_total", "Cache lookups that had to compute the value")
+cache_evictions = Counter("stationator_cache_evictions_total", "Entries evicted to keep caches within their size")
+refresh_seconds = Histogram(
+    "stationator_refresh_seconds", "Seconds spent by background refresh tasks",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+render_seconds = Histogram("stationator_render_seconds", "Seconds to render a trips page, by view")
+startup_seconds = Gauge("stationator_startup_seconds", "Seconds spent in each phase of starting the app")
+page_elements = Histogram(
+    "stationator_page_elements", "Elements on a rendered trips page, by view",
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
@@ -3,15 +3,25 @@
 import os
 import json
 import itertools
-import dateutil.parser
-import dateutil.tz
-import aiohttp
 import asyncio
+import contextvars
 import logging
+import time
+import backoff
+import metrics
+import persistence
+from routestore import RouteStore
+from triptable import TripTable
 from datetime import datetime, timedelta
 from functools import lru_cache, wraps
 from typing import Any, Callable, TypeVar
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,23 +32,107 @@ logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
 
-def async_lru_cache(maxsize: int = 128, typed: bool = False):
+def async_lru_cache(maxsize: int = 128, typed: bool = False, ttl=None, stale_ttl: float = 0, store=None):
+    """Cache the results of a coroutine function.
+
+    Args:
+        maxsize: Maximum number of entries kept, least recently used evicted first
+        typed: Unused, kept for signature compatibility with functools.lru_cache
+        ttl: Seconds an entry is fresh, or a callable receiving the call arguments
+            and returning those seconds. None keeps entries until evicted.
+        stale_ttl: Seconds after expiry during which the stale entry is still
+            returned immediately while it is refreshed in the background
+        store: Optional persistent store (see persistence.SqliteStore). Misses
+            are looked up in it and results are written to it off the event loop.
+    """
     cache = {}
+    # In-flight calls by key, so concurrent callers share a single request
+    pending = {}
 
     def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+
+        def on_done(key, entry_ttl, task):
+            pending.pop(key, None)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                # Errors are propagated to the waiting callers, never cached
+                logger.warning(f"Not caching failed call {func.__name__}{key}: {task.exception()}")
+                return
+            stored_at = time.time()
+            cache.pop(key, None)
+            cache[key] = (task.result(), stored_at, entry_ttl)
+            if len(cache) > maxsize:
+                # Remove least recently used item
+                cache.pop(next(iter(cache)))
+                metrics.cache_evictions.inc(cache=func.__name__)
+            if store is not None:
+                save = asyncio.get_running_loop().run_in_executor(
+                    None, store.save, key, task.result(), stored_at)
+                save.add_done_callback(on_saved)
+
+        def on_saved(future):
+            if future.exception() is not None:
+                logger.error(f"Failed to persist cache entry: {future.exception()}")
+
+        async def load(key, args, kwargs):
+            try:
+                loaded = await asyncio.to_thread(store.load, key)
+            except Exception as e:
+                logger.error(f"Failed to load persisted cache entry: {e}")
+                return
+            if loaded is not None and key not in cache:
+                value, stored_at = loaded
+                entry_ttl = ttl(*args, **kwargs) if callable(ttl) else ttl
+                cache[key] = (value, stored_at, entry_ttl)
+
+        def call(key, args, kwargs):
+            task = pending.get(key)
+            if task is None:
+                entry_ttl = ttl(*args, **kwargs) if callable(ttl) else ttl
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                pending[key] = task
+                task.add_done_callback(lambda t: on_done(key, entry_ttl, t))
+            return task
+
         @wraps(func)
         async def wrapper(*args: Any, **kwargs: Any) -> Any:
             key = str(args) + str(sorted(kwargs.items()))
-            if key not in cache:
-                cache[key] = await func(*args, **kwargs)
-                if len(cache) > maxsize:
-                    # Remove oldest item
-                    cache.pop(next(iter(cache)))
-            return cache[key]
+            if key not in cache and key not in pending and store is not None:
+                await load(key, args, kwargs)
+            if key in cache:
+                # Mark as recently used
+                value, stored_at, entry_ttl = cache[key] = cache.pop(key)
+                age = time.time() - stored_at
+                if entry_ttl is None or age < entry_ttl:
+                    metrics.cache_hits.inc(cache=func.__name__)
+                    return value
+                if age < entry_ttl + stale_ttl:
+                    # Serve stale data now, revalidate in the background
+                    metrics.cache_hits.inc(cache=func.__name__)
+                    call(key, args, kwargs)
+                    return value
+
+            metrics.cache_misses.inc(cache=func.__name__)
+            # Shield the shared call so one cancelled caller does not cancel
+            # it for everybody else waiting on the same key
+            try:
+                return await asyncio.shield(call(key, args, kwargs))
+            except Exception as e:
+                # Hand the last good value, however old, to callers that can fall back to it
+                if key in cache and getattr(e, "stale", None) is None:
+                    e.stale = cache[key][0]
+                raise
+
+        def peek(*args: Any, **kwargs: Any) -> Any:
+            """Return the cached result of a call, however old, or None, without calling."""
+            entry = cache.get(str(args) + str(sorted(kwargs.items())))
+            return entry[0] if entry else None
 
         def cache_clear():
             cache.clear()
 
+        wrapper.peek = peek
         wrapper.cache_clear = cache_clear
         return wrapper
     return decorator
@@ -52,64 +146,145 @@ class Station:
         d = datetime.strptime(station_data["biking_time"], "%H:%M")
         d = timedelta(hours=d.hour, minutes=d.minute)
         self.biking_time = d
+        # Whether the station is selected for users who did not choose yet
+        self.selected = station_data.get("selected", True)
+
+
+class RouteGroup:
+    """The station pairs whose direct trips make up a page, like "home" or "work".
+
+    Pairs are every origin to every destination, destinations first.
+    Pairs with a lower priority are fetched first when fetches have to
+    wait for each other; pairs default to priority 0.
+    """
+
+    def __init__(self, name, group_data):
+        self.name = name
+        self.pairs = [(o, d) for d in group_data["destinations"] for o in group_data["origins"] if o != d]
+        priorities = group_data.get("priorities", {})
+        self.priorities = {(o, d): priorities.get(f"{o}-{d}", 0) for o, d in self.pairs}
+
+
+def load_stations(path):
+    """Return the stations and route groups configured in the JSON file at path."""
+    with open(path) as f:
+        config = json.load(f)
+    stations = {code: Station({"short_name": code, **data}) for code, data in config["stations"].items()}
+    route_groups = {name: RouteGroup(name, data) for name, data in config["routes"].items()}
+    for group in route_groups.values():
+        unknown = {code for pair in group.pairs for code in pair} - stations.keys()
+        if unknown:
+            raise ValueError(f"Route group {group.name} in {path} uses unknown stations: {sorted(unknown)}")
+    return stations, route_groups
+
+
+STATIONS_CONFIG = os.getenv("STATIONATOR_STATIONS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.json"))
+stations, route_groups = load_stations(STATIONS_CONFIG)
+
+
+def pair_priority(origin, destination):
+    """Fetch priority of a station pair: the lowest of the route groups it is in."""
+    return min((g.priorities[(origin, destination)] for g in route_groups.values()
+                if (origin, destination) in g.priorities), default=0)
+
 
+def default_selection():
+    """Station selection of users who did not choose yet."""
+    return {code: station.selected for code, station in stations.items()}
 
-stations = {
-    "asd": Station(
-        {
-            "full_name": "Amsterdam Centraal",
-            "short_name": "asd",
-            "biking_time": "00:21",
-        }
-    ),
-    "asdz": Station(
-        {
-            "full_name": "Amsterdam Zuid",
-            "short_name": "asdz",
-            "biking_time": "00:05",
-        }
-    ),
-    "gvc": Station(
-        {
-            "full_name": "Den Haag Centraal",
-            "short_name": "gvc",
-            "biking_time": "00:15",
-        }
-    ),
-    "laa": Station(
-        {
-            "full_name": "Den Haag Laan van NOI",
-            "short_name": "laa",
-            "biking_time": "00:20",
-        }
-    ),
-}
+
+def selected_pairs(where_to, station_selection=None):
+    """Return the pairs of a route group between selected stations, or all of them without a selection."""
+    group = route_groups.get(where_to)
+    if group is None:
+        return []
+    if station_selection is None:
+        return list(group.pairs)
+    return [(o, d) for o, d in group.pairs if station_selection.get(o) and station_selection.get(d)]
+
+
+class PairRefs:
+    """Counts the open pages showing each station pair.
+
+    Pages register the station selection they keep in user storage. The
+    checkboxes change that selection in place, so counts always follow
+    what pages currently show.
+    """
+
+    def __init__(self):
+        self.pages = {}  # token -> (where_to, station_selection)
+        self._tokens = itertools.count()
+
+    def add(self, where_to, station_selection=None):
+        """Count the pairs a page shows until remove(token); None shows every pair."""
+        token = next(self._tokens)
+        self.pages[token] = (where_to, station_selection)
+        return token
+
+    def remove(self, token):
+        self.pages.pop(token, None)
+
+    def counts(self):
+        """Return {(origin, destination): pages showing it}."""
+        counts = {}
+        for where_to, station_selection in self.pages.values():
+            for pair in selected_pairs(where_to, station_selection):
+                counts[pair] = counts.get(pair, 0) + 1
+        return counts
+
+
+pair_refs = PairRefs()
 
 
 class Trip:
+    """A direct trip, holding only the fields the views use.
+
+    The raw NS trip payload (fares, stops, crowd forecasts, ...) is only
+    read while constructing the trip and is not retained.
+    """
+
+    __slots__ = (
+        "uid",
+        "checksum",
+        "status",
+        "transfers",
+        "origin",
+        "departure_track",
+        "departure_time",
+        "direction",
+        "destination",
+        "arrival_track",
+        "arrival_time",
+        "leave_by",
+        "arrive_by",
+        "biking_time",
+        "train_time",
+        "travel_time",
+    )
 
     def __init__(self, trip_data):
 
-        self.trip_data = trip_data
-        self.leg = self._leg()
+        leg = self._leg(trip_data)
 
+        self.uid = trip_uid(trip_data)
+        self.checksum = trip_data.get("checksum", None)
         self.status = trip_data["status"]
         self.transfers = trip_data["transfers"]
 
-        o = self.leg.get("origin", {})
+        o = leg.get("origin", {})
         self.origin = o["stationCode"].lower()
         self.departure_track = o.get(
             "actualTrack", o.get("plannedTrack", None))
         departure_time = o.get(
             "actualDateTime", o.get("plannedDateTime", None))
-        self.departure_time = dateutil.parser.isoparse(departure_time)
-        self.direction = self.leg.get("direction", None)
+        self.departure_time = _isoparse(departure_time)
+        self.direction = leg.get("direction", None)
 
-        d = self.leg.get("destination", {})
+        d = leg.get("destination", {})
         self.destination = d["stationCode"].lower()
         self.arrival_track = d.get("actualTrack", d.get("plannedTrack", None))
         arrival_time = d.get("actualDateTime", d.get("plannedDateTime", None))
-        self.arrival_time = dateutil.parser.isoparse(arrival_time)
+        self.arrival_time = _isoparse(arrival_time)
 
         self.leave_by = self._leave_by()
         self.arrive_by = self._arrive_by()
@@ -117,8 +292,9 @@ class Trip:
         self.train_time = self._train_time()
         self.travel_time = self.biking_time + self.train_time
 
-    def _leg(self):
-        legs = self.trip_data.get("legs", [])
+    @staticmethod
+    def _leg(trip_data):
+        legs = trip_data.get("legs", [])
 
         if legs:
             return legs[0]
@@ -168,12 +344,78 @@ class Trip:
             self.travel_time.strftime("%H:%M")},
         """
 
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
     def json(self):
-        return json.dumps(vars(self), default=str, sort_keys=True, indent=2)
+        return json.dumps(self.as_dict(), default=str, sort_keys=True, indent=2)
+
+
+def trip_uid(trip_data):
+    """Return the NS uid of a trip, or one derived from its first leg if missing."""
+    uid = trip_data.get("uid")
+    if uid:
+        return uid
+    legs = trip_data.get("legs", [])
+    leg = legs[0] if legs else {}
+    o = leg.get("origin", {})
+    d = leg.get("destination", {})
+    return f"{o.get('stationCode', '')}-{d.get('stationCode', '')}-{o.get('plannedDateTime', '')}".lower()
+
+
+_STOP_FIELDS = ("stationCode", "plannedTrack", "actualTrack", "plannedDateTime", "actualDateTime")
+
+
+def _compact_stop(stop):
+    return {k: stop[k] for k in _STOP_FIELDS if k in stop}
+
+
+def compact_trip(trip_data):
+    """Return a copy of an NS trip with only the fields Trip reads.
+
+    The result keeps the NS shape, so it can be fed to Trip or cached and
+    persisted in place of the full trip, which is tens of KB of fares,
+    stops and forecasts.
+    """
+    compact = {k: trip_data[k] for k in ("uid", "checksum", "status", "transfers") if k in trip_data}
+    legs = trip_data.get("legs", [])
+    if legs:
+        leg = legs[0]
+        compact["legs"] = [{
+            "direction": leg.get("direction", None),
+            "origin": _compact_stop(leg.get("origin", {})),
+            "destination": _compact_stop(leg.get("destination", {})),
+        }]
+    return compact
+
+
+def parse_trips_response(body):
+    """Decode an NS trips response, keeping only compact trips and scroll contexts."""
+    data = _json_loads(body)
+    return {
+        "trips": [compact_trip(t) for t in data.get("trips", [])],
+        "scrollRequestForwardContext": data.get("scrollRequestForwardContext", None),
+        "scrollRequestBackwardContext": data.get("scrollRequestBackwardContext", None),
+    }
+
+
+def _isoparse(value):
+    # Imported on first use, like aiohttp: dateutil takes about as long to
+    # import as the rest of this module, and the first trips come later.
+    # Replaces itself with isoparse, which runs for every trip parsed
+    global _isoparse
+    import dateutil.parser
+    _isoparse = dateutil.parser.isoparse
+    return _isoparse(value)
+
+
+def _amsterdam_tz():
+    import dateutil.tz
+    return dateutil.tz.gettz("Europe/Amsterdam")
 
 
 def get_amsterdam_time(hour=-1, round_to_hour=True):
-    dt = datetime.now(dateutil.tz.gettz("Europe/Amsterdam"))
+    dt = datetime.now(_amsterdam_tz())
 
     if hour >= 0 and hour < 24:
         dt = dt.replace(hour=hour)
@@ -184,13 +426,180 @@ def get_amsterdam_time(hour=-1, round_to_hour=True):
     return dt
 
 
-@async_lru_cache(maxsize=128)
-async def fetch_trips(origin="laa", destination="asdz", date_time=None):
-    url = "https://gateway.apiportal.ns.nl/reisinformatie-api/api/v3/trips"
-    api_key = os.getenv("NS_API_KEY")
-
+# Shared HTTP client, opened on app startup and closed on shutdown.
+# Reusing one connector keeps connections to the NS gateway alive between
+# pages and refresh cycles instead of paying a TCP+TLS handshake per request.
+_session = None
+
+
+def _create_session():
+    # Imported here: aiohttp and ssl take longer to import than the rest of
+    # this module, and only the app makes requests
+    import aiohttp
+    import ssl
+
+    connector = aiohttp.TCPConnector(
+        limit=int(os.getenv("NS_HTTP_POOL_SIZE", "8")),
+        limit_per_host=int(os.getenv("NS_HTTP_POOL_SIZE_PER_HOST", "4")),
+        keepalive_timeout=int(os.getenv("NS_HTTP_KEEPALIVE", "300")),
+        ttl_dns_cache=300,
+        ssl=ssl.create_default_context(),
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=float(os.getenv("NS_HTTP_TIMEOUT", "20")),
+        sock_connect=float(os.getenv("NS_HTTP_CONNECT_TIMEOUT", "5")),
+        sock_read=float(os.getenv("NS_HTTP_READ_TIMEOUT", "10")),
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def open_session():
+    """Open the shared HTTP session used by every fetch."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logger.info("Opened shared NS API session")
+    return _session
+
+
+async def close_session():
+    """Close the shared HTTP session and its pooled connections."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Closed shared NS API session")
+    _session = None
+
+
+async def get_session():
+    """Return the shared HTTP session, opening it lazily if needed."""
+    if _session is None or _session.closed:
+        return await open_session()
+    return _session
+
+
+def trips_ttl(origin="laa", destination="asdz", date_time=None, window=None):
+    """Seconds trips for an hour stay fresh: near hours change with delays, far ones hardly."""
     if not date_time:
-        date_time = get_amsterdam_time()
+        return 120
+
+    hours_ahead = (date_time - get_amsterdam_time()).total_seconds() / 3600
+    if -1 <= hours_ahead <= 1:
+        return 120
+    if hours_ahead <= 3:
+        return 600
+    return 1800
+
+
+class FetchError(Exception):
+    """A failed NS API request.
+
+    Retryable errors may succeed when tried again. stale is set to the
+    last good result for the request, when there is one.
+    """
+
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.stale = None
+
+
+class RateLimited(FetchError):
+    """The NS API quota was exceeded (429)."""
+
+    retryable = True
+
+
+class ServerError(FetchError):
+    """The NS API failed to answer (5xx)."""
+
+    retryable = True
+
+
+class NetworkError(FetchError):
+    """The request timed out or the connection failed."""
+
+    retryable = True
+
+
+class RequestError(FetchError):
+    """The NS API rejected the request (4xx other than 429), retrying will not help."""
+
+
+def classify_response(status, reason, retry_after=None):
+    """Return the FetchError for a response with a non-200 status."""
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    message = f"{status} {reason}"
+    if status == 429:
+        return RateLimited(message, status, retry_after)
+    if status >= 500:
+        return ServerError(message, status, retry_after)
+    return RequestError(message, status)
+
+
+# NS API trips endpoint; pointed at a stand-in by benchmarks/loadtest.py
+NS_TRIPS_URL = os.getenv("NS_TRIPS_URL", "https://gateway.apiportal.ns.nl/reisinformatie-api/api/v3/trips")
+
+# Requests to the NS API, matched to the subscription's quota
+rate_limiter = backoff.TokenBucket(
+    rate=float(os.getenv("NS_RATE_LIMIT", "5")),
+    capacity=float(os.getenv("NS_RATE_BURST", "10")),
+)
+# Station pairs fetched at a time; the others wait, lowest pair priority first
+fetch_limiter = backoff.PriorityLimiter(int(os.getenv("NS_FETCH_CONCURRENCY", "4")))
+# Added to the pair priority of fetches made in a context, so background work waits for pages
+fetch_priority = contextvars.ContextVar("fetch_priority", default=0)
+UNSELECTED_PRIORITY = 10
+# List the pair of every NS request made in a context is appended to, when set
+fetch_requests = contextvars.ContextVar("fetch_requests", default=None)
+RETRY_ATTEMPTS = int(os.getenv("NS_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("NS_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("NS_RETRY_MAX_DELAY", "8"))
+
+
+# Optional on-disk copy of fetched trips, so restarts start with a warm cache
+trips_store = persistence.open_store(os.getenv("STATIONATOR_CACHE_PATH"))
+
+
+# Pages are fetched until their trips cover this long after the requested time
+TRIPS_WINDOW = timedelta(minutes=int(os.getenv("NS_TRIPS_WINDOW_MINUTES", "120")))
+MAX_PAGES = int(os.getenv("NS_MAX_PAGES", "4"))
+
+# Backward scroll context of the earliest page fetched for (origin, destination, date_time),
+# so the previous hour can continue the same chain instead of starting a new search
+_backward_contexts = {}
+
+
+def _departure_time(trip_data):
+    legs = trip_data.get("legs", [])
+    if not legs:
+        return None
+    o = legs[0].get("origin", {})
+    departure_time = o.get("actualDateTime", o.get("plannedDateTime", None))
+    return _isoparse(departure_time) if departure_time else None
+
+
+def _departure_range(trips):
+    departures = [d for d in map(_departure_time, trips) if d]
+    if not departures:
+        return None, None
+    return min(departures), max(departures)
+
+
+async def _fetch_pages(origin, destination, date_time, window):
+    """Fetch pages of NS trips until they cover [date_time, date_time + window].
+
+    Returns the fetched trips, the FetchError that stopped fetching or None,
+    and whether there are no further pages.
+    """
+    url = NS_TRIPS_URL
+    api_key = os.getenv("NS_API_KEY")
 
     params = {
         "fromStation": origin,
@@ -200,50 +609,300 @@ async def fetch_trips(origin="laa", destination="asdz", date_time=None):
         "excludeTrainsWithReservationRequired": "True",
     }
 
+    # Continue backwards from the chain of the next hour when we have it
+    next_hour_context = _backward_contexts.get((origin, destination, date_time + timedelta(hours=1)))
+    if next_hour_context:
+        params["context"] = next_hour_context
+
     headers = {
         "Ocp-Apim-Subscription-Key": api_key,
     }
 
+    from aiohttp import ClientError
+
     trips = []
-    pages = 2
+    error = None
+    page = 0
+    forward_context = backward_context = None
     logger.info(f"Fetching trips from {origin} to {destination} at {date_time}")
-    for page in range(pages):
+    session = await get_session()
+
+    pair = f"{origin}-{destination}"
+
+    async def request():
+        await rate_limiter.acquire()
+        requests = fetch_requests.get()
+        if requests is not None:
+            requests.append(pair)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, headers=headers) as response:
-                    if response.status != 200:
-                        logger.error(f"Failed to fetch trips: {response.status} {response.reason}")
-                        raise Exception(response.status, response.reason, await response.json())
-                    data = await response.json()
-                    trips.extend(data.get('trips', []))
-                    params["context"] = data.get("scrollRequestForwardContext", None)
-                    logger.info(f"Successfully fetched {len(trips)} trips from {origin} to {destination} [{page + 1}/{pages}]")
-        except Exception as e:
-            logger.error(f"Exception while fetching trips: {e}")
+            async with session.get(url, params=params, headers=headers) as response:
+                if response.status != 200:
+                    raise classify_response(response.status, response.reason, response.headers.get("Retry-After"))
+                return parse_trips_response(await response.read())
+        except (ClientError, asyncio.TimeoutError) as e:
+            metrics.fetch_errors.inc(pair=pair, error="NetworkError")
+            raise NetworkError(f"{type(e).__name__}: {e}") from e
+        except FetchError as e:
+            metrics.fetch_errors.inc(pair=pair, error=type(e).__name__)
+            raise
+
+    async def fetch_page(context):
+        nonlocal page
+        page += 1
+        if context:
+            params["context"] = context
+        with metrics.fetch_seconds.time(pair=pair, page=page):
+            data = await backoff.retry(
+                request, RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                retryable=lambda e: isinstance(e, FetchError) and e.retryable)
+        logger.info(f"Successfully fetched {len(data['trips'])} trips from {origin} to {destination} [page {page}]")
+        return data
+
+    try:
+        data = await fetch_page(None)
+        trips.extend(data["trips"])
+        forward_context = data["scrollRequestForwardContext"]
+        backward_context = data["scrollRequestBackwardContext"]
+
+        # Page forward until the window is covered, or backward when the
+        # first page starts after the requested time
+        while page < MAX_PAGES:
+            first, last = _departure_range(trips)
+            if forward_context and (last is None or last < date_time + window):
+                data = await fetch_page(forward_context)
+                trips.extend(data["trips"])
+                forward_context = data["scrollRequestForwardContext"]
+            elif backward_context and first is not None and first > date_time:
+                data = await fetch_page(backward_context)
+                trips[:0] = data["trips"]
+                backward_context = data["scrollRequestBackwardContext"]
+            else:
+                break
+            if not data["trips"]:
+                break
+    except Exception as e:
+        error = e if isinstance(e, FetchError) else FetchError(f"{type(e).__name__}: {e}")
+        logger.error(f"Failed to fetch trips from {origin} to {destination} [page {page}]: {e}")
+
+    if backward_context:
+        _backward_contexts[(origin, destination, date_time)] = backward_context
+        if len(_backward_contexts) > 256:
+            _backward_contexts.pop(next(iter(_backward_contexts)))
+
+    logger.info(f"Fetched {len(trips)} trips from {origin} to {destination} in {page} pages")
+    return trips, error, not forward_context
+
+
+# Trips merged from every page fetched, by (origin, destination)
+route_stores = {}
+
+
+def _indexed_trips(trips):
+    """Return (departure epoch, uid, trip) for every trip with a departure time."""
+    indexed = []
+    for trip in trips:
+        departure_time = _departure_time(trip)
+        if departure_time is None:
+            continue
+        indexed.append((departure_time.timestamp(), trip_uid(trip), trip))
+    return indexed
+
+
+@async_lru_cache(maxsize=128, ttl=trips_ttl, stale_ttl=3600, store=trips_store)
+async def fetch_trips(origin="laa", destination="asdz", date_time=None, window=TRIPS_WINDOW):
+    """Return the trips from origin to destination departing in [date_time, date_time + window).
+
+    Trips are answered from the route store, only fetching the parts of the
+    window no fetch has covered within the TTL of that hour. If any part
+    fails, the FetchError is raised so the result is not cached, with the
+    trips known for the window as its stale result.
+    """
+    if not date_time:
+        date_time = get_amsterdam_time()
+
+    store = route_stores.setdefault((origin, destination), RouteStore())
+    start, end = date_time.timestamp(), (date_time + window).timestamp()
+    now = time.time()
+    fetched_after = now - trips_ttl(origin, destination, date_time)
+
+    errors = []
+    for gap_start, gap_end in store.gaps(start, end, fetched_after):
+        gap_time = datetime.fromtimestamp(gap_start, date_time.tzinfo)
+        gap_window = timedelta(seconds=gap_end - gap_start)
+        async with fetch_limiter.slot(pair_priority(origin, destination) + fetch_priority.get()):
+            trips, error, exhausted = await _fetch_pages(origin, destination, gap_time, gap_window)
+        if error:
+            errors.append(error)
+        indexed = _indexed_trips(trips)
+        # Without trips, only a fetch that ran out of pages tells the gap is
+        # empty; otherwise nothing is known to be covered
+        if not indexed and (error or not exhausted):
+            continue
+        # Everything from the requested time up to the last departure was
+        # seen, or up to the end of the window when there are no more pages
+        covered_start = min([gap_start] + [d for d, _, _ in indexed])
+        covered_end = max([d for d, _, _ in indexed] + ([gap_end] if exhausted and not error else []))
+        store.add(indexed, covered_start, covered_end, now)
+
+    store.prune(now - 86400)
+    trips = store.between(start, end)
+    if errors:
+        errors[0].stale = trips or None
+        raise errors[0]
+    logger.info(f"Serving {len(trips)} trips from {origin} to {destination} at {date_time}, {len(store)} stored")
+    return trips
+
+
+# Cached result of a fetch_trips call, however old, or None, without fetching
+peek_trips = fetch_trips.peek
 
+
+class ChangeSet:
+    """Uids of trips added, removed and updated in a new version of a trip table."""
+
+    __slots__ = ("version", "added", "removed", "updated")
+
+    def __init__(self, version, added=(), removed=(), updated=()):
+        self.version = version
+        self.added = list(added)
+        self.removed = list(removed)
+        self.updated = list(updated)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.updated)
+
+    def __repr__(self):
+        return f"ChangeSet(version={self.version}, added={len(self.added)}, removed={len(self.removed)}, updated={len(self.updated)})"
+
+
+def diff_trips(old, new):
+    """Return (added, removed, updated) uids between two {uid: checksum} mappings."""
+    added = [uid for uid in new if uid not in old]
+    removed = [uid for uid in old if uid not in new]
+    updated = [uid for uid, checksum in new.items() if uid in old and old[uid] != checksum]
+    return added, removed, updated
+
+
+# Version of the newest trip table, increased whenever any table changes
+data_version = 0
+
+# Parsed trips by uid, reused while their checksum does not change
+_parsed_trips = {}
+
+
+def _parse_trips(trips_data):
+    """Return Trips for the direct trips in trips_data, only parsing new or changed ones."""
+    trips = []
+    for trip_data in trips_data:
+        if trip_data["transfers"] != 0:
+            continue
+        uid = trip_uid(trip_data)
+        checksum = trip_data.get("checksum", None)
+        trip = _parsed_trips.get(uid)
+        if trip is None or checksum is None or trip.checksum != checksum:
+            trip = _parsed_trips[uid] = Trip(trip_data)
+        trips.append(trip)
+
+    while len(_parsed_trips) > 4096:
+        _parsed_trips.pop(next(iter(_parsed_trips)))
     return trips
 
 
-async def get_trips(where_to="home", date_time=None):
+def _with_fallbacks(results, stations):
+    """Replace failed fetch results by their stale data, returning (results, whether any failed)."""
+    stale = False
+    for i, result in enumerate(results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            origin, destination = stations[i]
+            logger.warning(f"Serving stale trips from {origin} to {destination}: {result}")
+            results[i] = getattr(result, "stale", None) or []
+            stale = True
+    return results, stale
+
+
+# Trip tables by (where_to, date_time), with the fetch results they were built from
+_trip_tables = {}
+
+# Callables notified with (where_to, date_time, table) whenever a new table version is built
+table_listeners = []
+
+
+async def _fetch_unselected(origin, destination, date_time):
+    """Fetch trips of a pair other pages show, behind the pairs of the requesting page."""
+    # gather runs this in its own task, so the priority stays in this fetch
+    fetch_priority.set(fetch_priority.get() + UNSELECTED_PRIORITY)
+    return await fetch_trips(origin, destination, date_time)
+
+
+async def get_trip_table(where_to="home", date_time=None, station_selection=None):
+    """Return the TripTable of direct trips of the route group where_to, sorted by departure.
+
+    Without a station selection every pair of the group is fetched. With
+    one, the pairs it selects are fetched, then the pairs other open pages
+    show (see pair_refs) at a lower priority; pairs nobody shows are only
+    taken from the cache, and fetched once a page selects them.
+
+    The table is rebuilt only when one of the underlying fetch results
+    changed, and only trips whose checksum changed are parsed again. Each
+    new table carries a data version and the ChangeSet from the previous
+    table for the same key.
+    """
+    global data_version
     ams_time = get_amsterdam_time(round_to_hour=False)
     logger.info(f"Getting trips to {where_to}")
 
-    if where_to == "work":
-        stations = [("laa", "asdz"), ("gvc", "asdz"), ("laa", "asd"), ("gvc", "asd")]
-        tasks = [fetch_trips(o, d, date_time) for o, d in stations]
-        results = await asyncio.gather(*tasks)
-        trips_data = itertools.chain.from_iterable(results)
-    elif where_to == "home":
-        stations = [("asdz", "laa"), ("asdz", "gvc"), ("asd", "laa"), ("asd", "gvc")]
-        tasks = [fetch_trips(o, d, date_time) for o, d in stations]
-        results = await asyncio.gather(*tasks)
-        trips_data = itertools.chain.from_iterable(results)
+    stale = False
+    group = route_groups.get(where_to)
+    if group:
+        selected = set(selected_pairs(where_to, station_selection))
+        shown = pair_refs.counts()
+        pairs = [p for p in group.pairs if p in selected or shown.get(p)]
+        # Fetches of cache misses wait for fetch_limiter, in pair priority order
+        tasks = [fetch_trips(o, d, date_time) if (o, d) in selected else _fetch_unselected(o, d, date_time)
+                 for o, d in pairs]
+        fetched, stale = _with_fallbacks(await asyncio.gather(*tasks, return_exceptions=True), pairs)
+        fetched = dict(zip(pairs, fetched))
+        results = [fetched[(o, d)] if (o, d) in fetched else peek_trips(o, d, date_time) or ()
+                   for o, d in group.pairs]
     else:
         logger.info("Using sample trip data")
-        with open("./sample_trip.json", "r") as f:
-            trips_data = json.load(f)["trips"]
-
-    trips = [Trip(t) for t in trips_data if Trip(t).transfers == 0]
+        with open("./sample_trip.json", "rb") as f:
+            results = [parse_trips_response(f.read())["trips"]]
+
+    key = (where_to, str(date_time))
+    cached = _trip_tables.get(key)
+    # Cached fetch results are returned as the same list objects until they
+    # are refreshed, so identity tells whether the table is still current
+    if (cached and cached[1].stale == stale and len(cached[0]) == len(results)
+            and all(a is b for a, b in zip(cached[0], results))):
+        return cached[1]
+
+    trips = _parse_trips(itertools.chain.from_iterable(results))
     trips = sorted(trips, key=lambda t: t.departure_time)
     logger.info(f"Found {len(trips)} direct trips to {where_to}")
-    return trips
+
+    previous = cached[1] if cached else None
+    old = {t.uid: t.checksum for t in previous.trips} if previous else {}
+    added, removed, updated = diff_trips(old, {t.uid: t.checksum for t in trips})
+    if (previous and previous.stale == stale and not (added or removed or updated)
+            and [t.uid for t in trips] == [t.uid for t in previous.trips]):
+        table = previous
+    else:
+        data_version += 1
+        changes = ChangeSet(data_version, added, removed, updated)
+        table = TripTable(trips, version=data_version, changes=changes, stale=stale)
+        logger.info(f"Trips to {where_to} at {date_time} changed: {changes}")
+        for listener in table_listeners:
+            listener(where_to, date_time, table)
+
+    _trip_tables.pop(key, None)
+    _trip_tables[key] = (results, table)
+    if len(_trip_tables) > 64:
+        _trip_tables.pop(next(iter(_trip_tables)))
+    return table
+
+
+async def get_trips(where_to="home", date_time=None, station_selection=None):
+    return (await get_trip_table(where_to, date_time, station_selection)).trips
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""SQLite backed persistent store for cached NS API responses."""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteStore:
+    """Key/value store of JSON values with the time they were fetched.
+
+    The database is opened on first use, so creating a store costs nothing at
+    import time. Methods are blocking and meant to be run off the event loop.
+    """
+
+    def __init__(self, path: str, max_age: float = 86400):
+        self.path = path
+        self.max_age = max_age
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, fetched_at REAL NOT NULL, data BLOB NOT NULL)"
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE fetched_at < ?", (time.time() - self.max_age,)
+            )
+            self._connection.commit()
+            logger.info(f"Opened persistent cache at {self.path}")
+        return self._connection
+
+    def load(self, key: str):
+        """Return (value, fetched_at) for key, or None if missing or too old."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data, fetched_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.max_age:
+            return None
+        return json.loads(zlib.decompress(row[0])), row[1]
+
+    def save(self, key: str, value, fetched_at: float):
+        """Store value for key, replacing any previous entry."""
+        data = zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, fetched_at, data) VALUES (?, ?, ?)",
+                (key, fetched_at, data),
+            )
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def open_store(path=None):
+    """Return a SqliteStore for path, or None when persistence is disabled."""
+    if not path:
+        return None
+    return SqliteStore(path)
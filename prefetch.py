@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Prefetch the trip pages people request, ahead of the times they request them."""
+import asyncio
+import logging
+import os
+from datetime import timedelta
+import ns
+
+logger = logging.getLogger(__name__)
+
+# Pages warmed on weekdays during the day when nothing was requested yet:
+# (where, hours from now)
+DEFAULT_PAGES = [(where, offset) for where in ns.route_groups for offset in (0, 1)]
+
+
+class AccessLog:
+    """Counts requested (where, hour) pages by the weekday and hour they were requested at.
+
+    Pages are stored relative to the hour of the request, so "the page
+    for the current hour, requested at 8 on Mondays" is one entry.
+    """
+
+    def __init__(self):
+        self.counts = {}  # (weekday, hour) -> {(where, offset): count}
+
+    def record(self, where, hour, now):
+        # where comes from the URL; anything else than a configured page
+        # would add entries that are never removed
+        if where not in ns.route_groups or not 0 <= hour < 24:
+            return
+        pages = self.counts.setdefault((now.weekday(), now.hour), {})
+        key = (where, hour - now.hour)
+        pages[key] = pages.get(key, 0) + 1
+
+    def demand(self, at):
+        """Return {(where, hour): count} of the pages requested in the weekday and hour of at."""
+        demand = {}
+        for (where, offset), count in self.counts.get((at.weekday(), at.hour), {}).items():
+            if 0 <= at.hour + offset < 24:
+                demand[(where, at.hour + offset)] = count
+        return demand
+
+
+class Prefetcher:
+    """Warms the pages most requested around the current time, under a budget of NS requests.
+
+    Every run warms pages concurrency at a time, ranked by how often they
+    were requested in this hour and the hour lead from now on the same
+    weekday. It stops starting pages once the pages warmed made budget
+    requests to NS; a page takes a request per station pair and page of
+    trips, or none when cached. At night and on weekends only pages with
+    recorded demand are warmed, with half the budget and less often.
+    """
+
+    def __init__(self, log, fetch, budget=4, concurrency=2, lead=timedelta(minutes=15),
+                 night=(0, 6), interval=300, quiet_interval=1800):
+        self.log = log
+        self.fetch = fetch
+        self.budget = budget
+        self.concurrency = concurrency
+        self.lead = lead
+        self.night = night
+        self.interval = interval
+        self.quiet_interval = quiet_interval
+
+    def is_quiet(self, now):
+        return now.weekday() >= 5 or self.night[0] <= now.hour < self.night[1]
+
+    def request_budget(self, now):
+        return max(1, self.budget // 2) if self.is_quiet(now) else self.budget
+
+    def plan(self, now):
+        """Return the (where, hour) pages to warm at now, most requested first.
+
+        Each page takes at least a request unless cached, so there are at
+        most as many pages as requests in the budget.
+        """
+        demand = {}
+        for at in (now, now + self.lead):
+            for page, count in self.log.demand(at).items():
+                demand[page] = demand.get(page, 0) + count
+
+        quiet = self.is_quiet(now)
+        if not quiet:
+            for where, offset in DEFAULT_PAGES:
+                if now.hour + offset < 24:
+                    demand.setdefault((where, now.hour + offset), 0)
+
+        return sorted(demand, key=lambda page: (-demand[page], page))[:self.request_budget(now)]
+
+    async def run_once(self, now=None):
+        """Warm the planned pages until the request budget is spent, returning the pages warmed."""
+        now = now or ns.get_amsterdam_time(round_to_hour=False)
+        budget = self.request_budget(now)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        requests = []
+        pages = []
+
+        async def warm(where, hour):
+            async with semaphore:
+                if len(requests) >= budget:
+                    return
+                pages.append((where, hour))
+                # gather runs this in its own task, so requests of other callers are not counted
+                ns.fetch_requests.set(requests)
+                try:
+                    await self.fetch(where, hour)
+                except Exception as e:
+                    logger.error(f"Failed to prefetch trips for {where} at hour {hour}: {e}")
+
+        await asyncio.gather(*(warm(where, hour) for where, hour in self.plan(now)))
+        logger.info(f"Prefetched {len(pages)} pages with {len(requests)} NS requests: {pages}")
+        return pages
+
+    def next_run(self, now=None):
+        """Seconds to wait before the next run."""
+        now = now or ns.get_amsterdam_time(round_to_hour=False)
+        return self.quiet_interval if self.is_quiet(now) else self.interval
+
+
+async def fetch_page(where, hour):
+    # Warm what users who did not change their selection see
+    await ns.get_trip_table(where, ns.get_amsterdam_time(hour), ns.default_selection())
+
+
+def _night():
+    start, end = os.getenv("STATIONATOR_PREFETCH_NIGHT", "0-6").split("-")
+    return int(start), int(end)
+
+
+access_log = AccessLog()
+default_prefetcher = Prefetcher(
+    access_log,
+    fetch_page,
+    budget=int(os.getenv("STATIONATOR_PREFETCH_BUDGET", "4")),
+    concurrency=int(os.getenv("STATIONATOR_PREFETCH_CONCURRENCY", "2")),
+    night=_night(),
+)
+
+
+def record(where, hour):
+    """Record a request for the trips page of where at hour."""
+    access_log.record(where, hour, ns.get_amsterdam_time(round_to_hour=False))
+
+
+async def run_once():
+    return await default_prefetcher.run_once()
+
+
+def next_run():
+    return default_prefetcher.next_run()
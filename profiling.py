@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Opt-in cProfile and tracemalloc reports of page renders and refresh cycles.
+
+Enabled with STATIONATOR_PROFILE=1 or at runtime through /admin/profiling.
+Reports are written to STATIONATOR_PROFILE_DIR, at most
+STATIONATOR_PROFILE_MAX_PER_HOUR of them, so it can be left on.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from functools import wraps
+import backoff
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Profiles one block at a time, within a budget of reports per hour.
+
+    cProfile sees everything the event loop runs while a block is
+    profiled, including other pages and tasks, so reports are samples of
+    the whole process during that block.
+    """
+
+    def __init__(self, directory, enabled=False, max_per_hour=6, top=30):
+        self.directory = directory
+        self.enabled = enabled
+        self.top = top
+        self.budget = backoff.TokenBucket(rate=max_per_hour / 3600, capacity=max_per_hour)
+        self.active = False
+
+    @asynccontextmanager
+    async def profile(self, name):
+        """Profile the with block, writing a report unless disabled, busy or over budget."""
+        if not self.enabled or self.active or not self.budget.try_acquire():
+            yield
+            return
+
+        self.active = True
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            self.active = False
+            try:
+                path = await asyncio.to_thread(self.write, name, profile, snapshot, elapsed)
+                logger.info(f"Profiled {name} in {elapsed:.3f}s, report in {path}")
+            except Exception as e:
+                logger.error(f"Failed to write profile of {name}: {e}")
+
+    def write(self, name, profile, snapshot, elapsed):
+        """Write the cProfile dump and a text report of hot functions and allocations."""
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}-{name}")
+        profile.dump_stats(f"{base}.prof")
+
+        report = io.StringIO()
+        report.write(f"{name}: {elapsed:.3f}s\n\n")
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+        report.write(f"Top {self.top} allocations by line\n")
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            report.write(f"{stat}\n")
+        with open(f"{base}.txt", "w") as f:
+            f.write(report.getvalue())
+        return f"{base}.txt"
+
+
+default_profiler = Profiler(
+    os.getenv("STATIONATOR_PROFILE_DIR", "profiles"),
+    enabled=os.getenv("STATIONATOR_PROFILE", "0") == "1",
+    max_per_hour=int(os.getenv("STATIONATOR_PROFILE_MAX_PER_HOUR", "6")),
+)
+
+
+def profile(name):
+    """Profile a block with the default profiler: async with profiling.profile("name"): ..."""
+    return default_profiler.profile(name)
+
+
+def profiled(name):
+    """Decorate a coroutine function to profile its calls with the default profiler."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with default_profiler.profile(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
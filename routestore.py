@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Time-indexed store of the trips fetched for each origin/destination pair."""
+import bisect
+
+
+class RouteStore:
+    """Trips of one origin/destination pair, merged from every fetched page.
+
+    Trips are deduplicated by uid and indexed by departure time (epoch
+    seconds), so any time window can be answered from memory. The store
+    also tracks which time intervals were covered by a fetch and when,
+    so callers only need to fetch the gaps.
+    """
+
+    def __init__(self):
+        self.trips = {}  # uid -> (departure, trip)
+        self.departures = []  # sorted (departure, uid)
+        self.covered = []  # sorted, disjoint [start, end, fetched_at]
+
+    def __len__(self):
+        return len(self.trips)
+
+    def _remove(self, uid):
+        departure, _ = self.trips.pop(uid)
+        i = bisect.bisect_left(self.departures, (departure, uid))
+        del self.departures[i]
+
+    def add(self, trips, start, end, fetched_at):
+        """Merge (departure, uid, trip) tuples fetched for the interval [start, end].
+
+        Trips previously stored in that interval which were not fetched
+        again are dropped, since the fetch is the newer picture of it.
+        """
+        uids = {uid for _, uid, _ in trips}
+        lo = bisect.bisect_left(self.departures, (start, ""))
+        hi = bisect.bisect_right(self.departures, (end, "\uffff"))
+        for _, uid in self.departures[lo:hi]:
+            if uid not in uids:
+                self._remove(uid)
+
+        for departure, uid, trip in trips:
+            if uid in self.trips:
+                self._remove(uid)
+            self.trips[uid] = (departure, trip)
+            bisect.insort(self.departures, (departure, uid))
+
+        self._cover(start, end, fetched_at)
+
+    def _cover(self, start, end, fetched_at):
+        covered = [[start, end, fetched_at]]
+        for s, e, f in self.covered:
+            # Keep the parts of older intervals outside the new one
+            if s < min(e, start):
+                covered.append([s, min(e, start), f])
+            if max(s, end) < e:
+                covered.append([max(s, end), e, f])
+        self.covered = sorted(covered)
+
+    def between(self, start, end):
+        """Return trips departing in [start, end), sorted by departure."""
+        lo = bisect.bisect_left(self.departures, (start, ""))
+        hi = bisect.bisect_left(self.departures, (end, ""))
+        return [self.trips[uid][1] for _, uid in self.departures[lo:hi]]
+
+    def gaps(self, start, end, fetched_after):
+        """Return the (start, end) parts of [start, end) not covered since fetched_after."""
+        gaps = []
+        position = start
+        for s, e, f in self.covered:
+            if f < fetched_after or e <= position:
+                continue
+            if s >= end:
+                break
+            if s > position:
+                gaps.append((position, s))
+            position = max(position, e)
+            if position >= end:
+                break
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def prune(self, before):
+        """Forget trips departing and intervals ending before the given time."""
+        hi = bisect.bisect_left(self.departures, (before, ""))
+        for _, uid in self.departures[:hi]:
+            del self.trips[uid]
+        del self.departures[:hi]
+        self.covered = [c for c in self.covered if c[1] >= before]
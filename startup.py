@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Time spent starting the app, from process start to the first page served.
+
+main.py times its imports and startup hooks with timed(); views are
+imported on the first request for one of their pages. The phases are
+logged once the app is up and again after the first page, and exposed
+as stationator_startup_seconds in /metrics.
+"""
+import importlib
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Monotonic time at which this module, imported first by main.py, was imported
+imported_at = time.perf_counter()
+
+# Seconds per phase, in the order the phases ran
+phases = {}
+
+# Whether page_served() reported the first page yet
+first_page_served = False
+
+
+def process_age():
+    """Seconds since this process started, or None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name, which may contain spaces; starttime is field 22
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Interpreter start up to the import of this module
+_age = process_age()
+if _age is not None:
+    phases["interpreter"] = _age
+
+
+@contextmanager
+def timed(phase):
+    """Record the seconds spent in the with block as a startup phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+
+
+def load_view(name):
+    """Import a view module, registering its pages, unless it was imported already."""
+    if name in sys.modules:
+        return
+    with timed(f"import {name}"):
+        importlib.import_module(name)
+    logger.info(f"Loaded view {name} in {phases[f'import {name}'] * 1000:.0f}ms")
+
+
+def since_start():
+    """Seconds since the process started, or since this module was imported."""
+    return phases.get("interpreter", 0) + time.perf_counter() - imported_at
+
+
+def report(title):
+    """Log the startup phases so far and publish them as metrics."""
+    lines = [f"{title} {since_start():.2f}s after process start:"]
+    for phase, seconds in phases.items():
+        lines.append(f"  {phase:24} {seconds * 1000:8.0f}ms")
+        metrics.startup_seconds.set(seconds, phase=phase)
+    logger.info("\n".join(lines))
+
+
+def page_served(path):
+    """Report the startup phases once, when the first page is served."""
+    global first_page_served
+    if not first_page_served:
+        first_page_served = True
+        report(f"Served the first page, {path},")
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 from nicegui import app
+import ns
 
 
 def init_storage():
     """Initialize storage for the current user."""
-    if not app.storage.user.get('station_selection'):
+    selection = app.storage.user.get('station_selection') or {}
+    if selection.keys() != ns.stations.keys():
+        # Stations added to the configuration start out with their default
         app.storage.user['station_selection'] = {
-            "asd": False,  # Amsterdam Centraal
-            "asdz": True,  # Amsterdam Zuid
-            "gvc": True,  # Den Haag Centraal
-            "laa": True,  # Den Haag Laan van NOI
-        }
\ No newline at end of file
+            code: selection.get(code, station.selected) for code, station in ns.stations.items()
+        }
@@ -1,11 +1,68 @@
 #!/usr/bin/env python3
 import unittest
 import asyncio
-from datetime import timedelta
+import contextvars
+from datetime import datetime, timedelta
+import dateutil.tz
 import json
 import gzip
+import os
+import tempfile
 from unittest.mock import patch, AsyncMock
+import backoff
+import fragments
+import metrics
+import hub
+import ns
+import persistence
+import prefetch
+import profiling
+import startup
+import sys
 from ns import get_trips, get_amsterdam_time
+from routestore import RouteStore
+from triptable import TripTable
+
+
+class FakeResponse:
+    def __init__(self, data, status=200, headers=None):
+        self.data = data
+        self.status = status
+        self.reason = "OK" if status == 200 else "Error"
+        self.headers = headers or {}
+
+    async def json(self):
+        return self.data
+
+    async def read(self):
+        return json.dumps(self.data).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeSession:
+    """Replays a list of NS responses and records the requests made.
+
+    Pages may also be FakeResponses, to reply with an error status, or
+    exceptions to raise.
+    """
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+        self.closed = False
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append(dict(params or {}))
+        page = self.pages.pop(0)
+        if isinstance(page, Exception):
+            raise page
+        return page if isinstance(page, FakeResponse) else FakeResponse(page)
+
 
 class TestGetTrips(unittest.TestCase):
     def setUp(self):
@@ -84,5 +141,762 @@ class TestGetTrips(unittest.TestCase):
         for i in range(len(trips) - 1):
             self.assertLessEqual(trips[i].departure_time, trips[i + 1].departure_time)
 
+
+class TestStationConfig(unittest.TestCase):
+    def write_config(self, config):
+        path = os.path.join(tempfile.mkdtemp(), "stations.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        return path
+
+    def test_route_group_is_a_matrix_of_pairs(self):
+        stations, route_groups = ns.load_stations(self.write_config({
+            "stations": {code: {"full_name": code, "biking_time": "00:10"} for code in ("a", "b", "x", "y", "z")},
+            "routes": {"work": {"origins": ["a", "b"], "destinations": ["x", "y", "z"], "priorities": {"b-z": 2}}},
+        }))
+        group = route_groups["work"]
+        self.assertEqual(group.pairs, [("a", "x"), ("b", "x"), ("a", "y"), ("b", "y"), ("a", "z"), ("b", "z")])
+        self.assertEqual(group.priorities[("b", "z")], 2)
+        self.assertEqual(group.priorities[("a", "x")], 0)
+        self.assertEqual(stations["a"].biking_time, timedelta(minutes=10))
+        self.assertTrue(stations["a"].selected)
+
+    def test_unknown_stations_are_rejected(self):
+        path = self.write_config({
+            "stations": {"a": {"full_name": "A", "biking_time": "00:10"}},
+            "routes": {"work": {"origins": ["a"], "destinations": ["q"]}},
+        })
+        with self.assertRaises(ValueError):
+            ns.load_stations(path)
+
+    def test_default_config_has_the_commute_pairs(self):
+        self.assertEqual(set(ns.route_groups["work"].pairs), {("laa", "asdz"), ("gvc", "asdz"), ("laa", "asd"), ("gvc", "asd")})
+        self.assertEqual(set(ns.route_groups["home"].pairs), {("asdz", "laa"), ("asdz", "gvc"), ("asd", "laa"), ("asd", "gvc")})
+        self.assertLess(ns.pair_priority("laa", "asdz"), ns.pair_priority("laa", "asd"))
+
+    @patch('ns.fetch_trips')
+    def test_get_trip_table_fetches_the_pairs_of_the_group(self, mock_fetch_trips):
+        fetched = []
+
+        async def mock_fetch(origin, destination, date_time=None):
+            fetched.append((origin, destination))
+            return []
+        mock_fetch_trips.side_effect = mock_fetch
+
+        group = ns.RouteGroup("commute", {"origins": ["laa", "gvc"], "destinations": ["asd"]})
+        with patch.dict(ns.route_groups, {"commute": group}):
+            asyncio.run(ns.get_trip_table("commute"))
+        self.assertEqual(fetched, [("laa", "asd"), ("gvc", "asd")])
+
+
+class TestSelectedPairs(unittest.TestCase):
+    def setUp(self):
+        self.selection = {"asd": False, "asdz": True, "gvc": True, "laa": True}
+        self.fetched = {}
+
+        async def mock_fetch(origin, destination, date_time=None):
+            self.fetched[(origin, destination)] = ns.fetch_priority.get()
+            return []
+        for patcher in (patch('ns.fetch_trips', side_effect=mock_fetch), patch('ns.pair_refs', ns.PairRefs())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_selection_selects_pairs_between_selected_stations(self):
+        self.assertEqual(ns.selected_pairs("work", self.selection), [("laa", "asdz"), ("gvc", "asdz")])
+        self.assertEqual(len(ns.selected_pairs("work")), 4)
+        self.assertEqual(ns.selected_pairs("other", self.selection), [])
+
+    def test_only_selected_pairs_are_fetched(self):
+        cached = make_page(["09:06"])["trips"]
+        cached[0]["legs"][0]["origin"]["stationCode"] = "GVC"
+        cached[0]["legs"][0]["destination"]["stationCode"] = "ASD"
+        cached[0]["uid"] = "gvc-asd-09:06"
+
+        def peek(origin, destination, date_time):
+            return cached if (origin, destination) == ("gvc", "asd") else None
+
+        with patch('ns.peek_trips', side_effect=peek):
+            table = asyncio.run(ns.get_trip_table("work", get_amsterdam_time(5), self.selection))
+        self.assertEqual(set(self.fetched), {("laa", "asdz"), ("gvc", "asdz")})
+        # Unselected pairs still show what is cached for them
+        self.assertEqual([t.origin for t in table.trips], ["gvc"])
+
+    def test_pairs_other_pages_show_are_fetched_behind_the_selection(self):
+        token = ns.pair_refs.add("work", {"gvc": True, "asd": True})
+        self.addCleanup(ns.pair_refs.remove, token)
+        asyncio.run(ns.get_trip_table("work", get_amsterdam_time(6), self.selection))
+        self.assertEqual(self.fetched, {("laa", "asdz"): 0, ("gvc", "asdz"): 0,
+                                        ("gvc", "asd"): ns.UNSELECTED_PRIORITY})
+
+    def test_pair_refs_follow_selection_changes(self):
+        refs = ns.PairRefs()
+        first = refs.add("work", self.selection)
+        refs.add("work", self.selection)
+        self.assertEqual(refs.counts(), {("laa", "asdz"): 2, ("gvc", "asdz"): 2})
+        self.selection["laa"] = False
+        refs.remove(first)
+        self.assertEqual(refs.counts(), {("gvc", "asdz"): 1})
+
+    def test_subscribers_count_their_pairs_until_unsubscribed(self):
+        test_hub = hub.Hub()
+        subscription = test_hub.subscribe("home", 8, lambda table, changes: None, station_selection=self.selection)
+        self.assertEqual(ns.pair_refs.counts().get(("asdz", "laa")), 1)
+        test_hub.unsubscribe(subscription)
+        self.assertIsNone(ns.pair_refs.counts().get(("asdz", "laa")))
+
+
+class TestDeltaRefresh(unittest.TestCase):
+    @patch('ns.fetch_trips')
+    def test_refresh_reports_changes_and_reuses_unchanged_trips(self, mock_fetch_trips):
+        first = make_page(["09:06", "09:21", "09:36"])["trips"]
+        second = make_page(["09:21", "09:36", "09:51"])["trips"]
+        second[1]["checksum"] = "2"
+        pages = {"laa-asdz": first}
+
+        async def mock_fetch(origin, destination, date_time=None):
+            return pages.get(f"{origin}-{destination}", [])
+        mock_fetch_trips.side_effect = mock_fetch
+
+        before = asyncio.run(ns.get_trip_table("work", get_amsterdam_time(3)))
+        self.assertIs(asyncio.run(ns.get_trip_table("work", get_amsterdam_time(3))), before)
+        pages["laa-asdz"] = second
+        after = asyncio.run(ns.get_trip_table("work", get_amsterdam_time(3)))
+
+        self.assertGreater(after.version, before.version)
+        self.assertEqual(after.changes.added, ["laa-asdz-09:51"])
+        self.assertEqual(after.changes.removed, ["laa-asdz-09:06"])
+        self.assertEqual(after.changes.updated, ["laa-asdz-09:36"])
+        self.assertIs(after.trips[0], before.trips[1])
+        self.assertIsNot(after.trips[1], before.trips[2])
+
+
+    @patch('ns.fetch_trips')
+    def test_failed_fetch_falls_back_to_stale_trips(self, mock_fetch_trips):
+        pages = {"laa-asdz": make_page(["09:06", "09:21"])["trips"]}
+
+        async def mock_fetch(origin, destination, date_time=None):
+            if f"{origin}-{destination}" == "gvc-asdz":
+                error = ns.ServerError("503 Service Unavailable", 503)
+                error.stale = make_page(["09:11"])["trips"]
+                raise error
+            return pages.get(f"{origin}-{destination}", [])
+        mock_fetch_trips.side_effect = mock_fetch
+
+        table = asyncio.run(ns.get_trip_table("work", get_amsterdam_time(4)))
+        self.assertTrue(table.stale)
+        self.assertEqual(len(table), 3)
+
+
+class TestHub(unittest.TestCase):
+    def test_merge_changes(self):
+        older = ns.ChangeSet(1, added=["a"], removed=["b"], updated=["c"])
+        newer = ns.ChangeSet(2, added=["b", "d"], removed=["a"], updated=["c", "e"])
+        merged = hub.merge_changes(older, newer)
+        self.assertEqual(merged.version, 2)
+        self.assertEqual(merged.added, ["d"])
+        self.assertEqual(merged.removed, [])
+        self.assertEqual(sorted(merged.updated), ["b", "c", "e"])
+
+    def test_changes_are_throttled_and_merged(self):
+        received = []
+        trips_hub = hub.Hub()
+
+        async def run():
+            trips_hub.subscribe("work", 8, lambda table, changes: received.append(changes), min_interval=0.05)
+            for version, uid in enumerate(["a", "b", "c"], start=1):
+                table = TripTable([], version=version, changes=ns.ChangeSet(version, added=[uid]))
+                trips_hub.publish(("work", 8), table)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        self.assertEqual([c.added for c in received], [["a"], ["b", "c"]])
+
+    def test_changes_are_not_delivered_in_the_context_of_the_publisher(self):
+        request = contextvars.ContextVar("request", default=None)
+        received = []
+        trips_hub = hub.Hub()
+
+        async def publish():
+            # The table is rebuilt while another page's request is served
+            request.set("another page")
+            trips_hub.publish(("work", 8), TripTable([], version=1, changes=ns.ChangeSet(1, added=["a"])))
+
+        async def run():
+            trips_hub.subscribe("work", 8, lambda table, changes: received.append(request.get()), min_interval=0)
+            await asyncio.create_task(publish())
+            await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        self.assertEqual(received, [None])
+
+
+class TestFragmentCache(unittest.TestCase):
+    def test_fragments_are_shared_and_evicted(self):
+        cache = fragments.FragmentCache(maxsize=2)
+        renders = []
+
+        def render(name):
+            return lambda: renders.append(name) or name
+
+        self.assertEqual(cache.get(("v3", "work", 1), render("a")), "a")
+        self.assertEqual(cache.get(("v3", "work", 1), render("again")), "a")
+        cache.get(("v3", "work", 2), render("b"))
+        cache.get(("v3", "work", 1), render("again"))
+        cache.get(("v3", "work", 3), render("c"))
+        # The least recently used fragment is evicted
+        self.assertEqual(cache.get(("v3", "work", 2), render("b2")), "b2")
+        self.assertEqual(renders, ["a", "b", "c", "b2"])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 4, 2))
+
+    def test_selection_key(self):
+        self.assertEqual(fragments.selection_key({"laa": True, "asd": False, "gvc": True}), ("gvc", "laa"))
+        self.assertIsNone(fragments.selection_key(None))
+
+
+class TestPrefetch(unittest.TestCase):
+    # A Monday and a Saturday
+    MONDAY = datetime(2025, 11, 10, 7, 50, tzinfo=dateutil.tz.gettz("Europe/Amsterdam"))
+    SATURDAY = datetime(2025, 11, 15, 7, 50, tzinfo=dateutil.tz.gettz("Europe/Amsterdam"))
+
+    def make_prefetcher(self, fetched, **kwargs):
+        async def fetch(where, hour):
+            fetched.append((where, hour))
+
+        return prefetch.Prefetcher(prefetch.AccessLog(), fetch, **kwargs)
+
+    def test_requested_pages_are_warmed_first(self):
+        prefetcher = self.make_prefetcher([], budget=3)
+        # Requested last Monday at 8:10 for 8, and at 7:30 for 9
+        for _ in range(3):
+            prefetcher.log.record("work", 8, self.MONDAY.replace(hour=8, minute=10) - timedelta(days=7))
+        prefetcher.log.record("work", 9, self.MONDAY.replace(minute=30) - timedelta(days=7))
+        # At 7:50 the 8 o'clock demand is within the lead time
+        self.assertEqual(prefetcher.plan(self.MONDAY), [("work", 8), ("work", 9), ("home", 7)])
+
+    def test_quiet_times_only_warm_requested_pages(self):
+        prefetcher = self.make_prefetcher([], budget=4)
+        self.assertEqual(len(prefetcher.plan(self.MONDAY)), 4)
+        self.assertEqual(prefetcher.plan(self.MONDAY.replace(hour=3)), [])
+        self.assertEqual(prefetcher.plan(self.SATURDAY), [])
+        for where in ("home", "work", "home"):
+            prefetcher.log.record(where, 7, self.SATURDAY - timedelta(days=7))
+        self.assertEqual(prefetcher.plan(self.SATURDAY), [("home", 7), ("work", 7)])
+        self.assertEqual(prefetcher.next_run(self.SATURDAY), prefetcher.quiet_interval)
+        self.assertEqual(prefetcher.next_run(self.MONDAY), prefetcher.interval)
+
+    def test_only_configured_pages_are_recorded(self):
+        log = prefetch.AccessLog()
+        log.record("work", 8, self.MONDAY)
+        log.record("wp-admin", 8, self.MONDAY)
+        self.assertEqual(log.demand(self.MONDAY), {("work", 8): 1})
+
+    def test_run_stops_when_the_request_budget_is_spent(self):
+        async def fetch(where, hour):
+            # Three station pairs, a page of trips each
+            ns.fetch_requests.get().extend(["laa-asdz", "gvc-asdz", "laa-asd"])
+
+        prefetcher = prefetch.Prefetcher(prefetch.AccessLog(), fetch, budget=4, concurrency=1)
+        self.assertEqual(len(prefetcher.plan(self.MONDAY)), 4)
+        pages = asyncio.run(prefetcher.run_once(self.MONDAY))
+        self.assertEqual(len(pages), 2)
+
+    def test_run_is_concurrent_under_a_limit(self):
+        active = []
+        peak = []
+
+        async def fetch(where, hour):
+            active.append(where)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(where)
+
+        prefetcher = prefetch.Prefetcher(prefetch.AccessLog(), fetch, budget=4, concurrency=2)
+        pages = asyncio.run(prefetcher.run_once(self.MONDAY))
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(max(peak), 2)
+
+
+class TestTrip(unittest.TestCase):
+    def test_trip_does_not_keep_raw_payload(self):
+        with open("sample_trip.json", "r") as f:
+            trip = ns.Trip(json.load(f)["trips"][0])
+        self.assertFalse(hasattr(trip, "__dict__"))
+        self.assertFalse(hasattr(trip, "trip_data"))
+        self.assertEqual(set(trip.as_dict()), set(ns.Trip.__slots__))
+        self.assertEqual(trip.leave_by, trip.departure_time - ns.stations[trip.origin].biking_time)
+
+
+class TestTripTable(unittest.TestCase):
+    def setUp(self):
+        with gzip.open("sample-trips.json.gz", "rt", encoding="utf-8") as f:
+            sample_data = json.load(f)
+        trips = [ns.Trip(t) for k in ("asdz-laa", "asd-gvc", "asdz-gvc") for t in sample_data[k]["trips"] if t["transfers"] == 0]
+        self.trips = sorted(trips, key=lambda t: t.departure_time)
+        self.table = TripTable(self.trips)
+        self.selection = {"asd": False, "asdz": True, "gvc": True, "laa": True}
+
+    def test_select_filters_and_sorts(self):
+        expected = sorted(
+            (t for t in self.trips if self.selection[t.origin] and self.selection[t.destination]),
+            key=lambda t: t.arrival_time)
+        selected = self.table.select(self.selection, order="arrival")
+        self.assertEqual([t.arrival_time for t in selected], [t.arrival_time for t in expected])
+        self.assertEqual(len(selected), len(expected))
+        self.assertTrue(all(t.origin == "asdz" for t in selected))
+
+    def test_select_by_status(self):
+        selected = self.table.select(statuses=["NORMAL"])
+        self.assertEqual(selected, [t for t in self.trips if t.status == "NORMAL"])
+
+    def test_group_by(self):
+        groups = self.table.group_by("destination", self.selection)
+        self.assertEqual(list(groups), ["gvc", "laa"])
+        self.assertTrue(all(t.destination == "gvc" for t in groups["gvc"]))
+
+    def test_empty_table(self):
+        self.assertEqual(TripTable([]).select(self.selection), [])
+
+
+class TestRouteStore(unittest.TestCase):
+    def test_refetch_replaces_trips_in_interval(self):
+        store = RouteStore()
+        store.add([(10, "a", "A"), (20, "b", "B"), (30, "c", "C")], 0, 30, fetched_at=100)
+        store.add([(15, "a", "A'"), (30, "c", "C")], 10, 30, fetched_at=200)
+        self.assertEqual(store.between(0, 40), ["A'", "C"])
+        self.assertEqual(store.covered, [[0, 10, 100], [10, 30, 200]])
+
+    def test_gaps(self):
+        store = RouteStore()
+        store.add([], 10, 20, fetched_at=100)
+        store.add([], 30, 40, fetched_at=50)
+        self.assertEqual(store.gaps(0, 50, fetched_after=0), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(store.gaps(0, 50, fetched_after=60), [(0, 10), (20, 50)])
+        self.assertEqual(store.gaps(12, 18, fetched_after=60), [])
+
+
+def make_page(times, forward=None, backward=None, day="2024-12-04"):
+    """Build an NS trips response with one direct laa-asdz trip per HH:MM departure."""
+    trips = []
+    for hhmm in times:
+        h, m = map(int, hhmm.split(":"))
+        arrival = f"{(h + (m + 34) // 60):02d}:{(m + 34) % 60:02d}"
+        trips.append({
+            "uid": f"laa-asdz-{hhmm}",
+            "checksum": "1",
+            "status": "NORMAL",
+            "transfers": 0,
+            "legs": [{
+                "direction": "Amsterdam Centraal",
+                "origin": {"stationCode": "LAA", "plannedDateTime": f"{day}T{hhmm}:00+0100", "plannedTrack": "1"},
+                "destination": {"stationCode": "ASDZ", "plannedDateTime": f"{day}T{arrival}:00+0100", "plannedTrack": "2"},
+            }],
+        })
+    return {"trips": trips, "scrollRequestForwardContext": forward, "scrollRequestBackwardContext": backward}
+
+
+class TestFetchTrips(unittest.TestCase):
+    def setUp(self):
+        with open("sample-trips/sample-trips-laa-asdz-None.json", "r") as f:
+            self.page = json.load(f)
+        ns.fetch_trips.cache_clear()
+        ns._backward_contexts.clear()
+        ns.route_stores.clear()
+        self.date_time = datetime(2024, 12, 4, 9, tzinfo=dateutil.tz.tzoffset(None, 3600))
+
+    def fetch(self, session, date_time=None, window=timedelta(hours=1)):
+        with patch('ns.get_session', AsyncMock(return_value=session)), \
+                patch('ns.time.time', return_value=self.date_time.timestamp()):
+            return asyncio.run(ns.fetch_trips("laa", "asdz", date_time or self.date_time, window=window))
+
+    def test_pages_share_one_session(self):
+        session = FakeSession([
+            make_page(["09:06", "09:21", "09:36"], forward="f1"),
+            make_page(["09:51", "10:06"], forward="f2"),
+        ])
+        with patch('ns.get_session', AsyncMock(return_value=session)) as get_session, \
+                patch('ns.time.time', return_value=self.date_time.timestamp()):
+            trips = asyncio.run(ns.fetch_trips("laa", "asdz", self.date_time, window=timedelta(hours=1)))
+        get_session.assert_awaited_once()
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(session.requests[1]["context"], "f1")
+        self.assertEqual(len(trips), 4)
+
+    def test_stops_when_first_page_covers_window(self):
+        session = FakeSession([make_page(["09:06", "09:36", "10:06"], forward="f1")])
+        trips = self.fetch(session)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(len(trips), 2)
+
+    def test_empty_pages_are_an_empty_window(self):
+        session = FakeSession([make_page([], forward="f1"), make_page([], forward="f2")])
+        self.assertEqual(self.fetch(session), [])
+        self.assertEqual(len(session.requests), 2)
+        # The empty result is cached like any other
+        session = FakeSession([])
+        self.assertEqual(self.fetch(session), [])
+        self.assertEqual(session.requests, [])
+
+    def test_pages_backward_when_first_page_starts_late(self):
+        session = FakeSession([
+            make_page(["09:21", "09:51", "10:06"], forward="f1", backward="b1"),
+            make_page(["08:51", "09:06"], backward="b2"),
+        ])
+        trips = self.fetch(session)
+        self.assertEqual(session.requests[1]["context"], "b1")
+        self.assertEqual([t["uid"][-5:] for t in trips], ["09:06", "09:21", "09:51"])
+
+    def test_previous_hour_continues_chain(self):
+        self.fetch(FakeSession([make_page(["09:00", "10:06"], forward="f1", backward="b1")]))
+        session = FakeSession([make_page(["08:00", "08:36", "09:00"], forward="b1f", backward="b2")])
+        self.fetch(session, self.date_time - timedelta(hours=1))
+        self.assertEqual(session.requests[0]["context"], "b1")
+
+    def test_overlapping_hours_are_served_from_the_route_store(self):
+        self.fetch(FakeSession([make_page(["09:06", "09:36", "10:06", "10:36", "11:06"])]), window=timedelta(hours=2))
+        session = FakeSession([])
+        trips = self.fetch(session, self.date_time + timedelta(hours=1))
+        self.assertEqual(session.requests, [])
+        self.assertEqual([t["uid"][-5:] for t in trips], ["10:06", "10:36"])
+
+    def test_only_gaps_are_fetched(self):
+        self.fetch(FakeSession([make_page(["09:06", "09:36", "10:06"])]))
+        session = FakeSession([make_page(["10:06", "10:36", "11:06"])])
+        trips = self.fetch(session, self.date_time + timedelta(minutes=30))
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(session.requests[0]["dateTime"], "2024-12-04T10:06")
+        self.assertEqual([t["uid"][-5:] for t in trips], ["09:36", "10:06"])
+
+    def test_retryable_errors_are_retried(self):
+        session = FakeSession([
+            FakeResponse({}, status=429, headers={"Retry-After": "0"}),
+            asyncio.TimeoutError(),
+            make_page(["09:00", "09:30", "10:00"]),
+        ])
+        with patch('ns.RETRY_BASE_DELAY', 0):
+            trips = self.fetch(session)
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(len(trips), 2)
+
+    def test_errors_are_not_cached_and_carry_stale_trips(self):
+        self.fetch(FakeSession([make_page(["09:00", "09:30", "10:00"])]))
+        ns.fetch_trips.cache_clear()
+        # A later hour overlapping the stored trips fails with a client error, which is not retried
+        later = self.date_time + timedelta(minutes=30)
+        session = FakeSession([FakeResponse({}, status=401)])
+        with self.assertRaises(ns.RequestError) as raised:
+            self.fetch(session, later)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual([t["uid"][-5:] for t in raised.exception.stale], ["09:30", "10:00"])
+        # Nothing was cached, so the next call tries again
+        trips = self.fetch(FakeSession([make_page(["10:00", "10:30"])]), later)
+        self.assertEqual([t["uid"][-5:] for t in trips], ["09:30", "10:00"])
+
+    def test_response_is_parsed_into_compact_trips(self):
+        with open("sample-trips/sample-trips-laa-asdz-None.json", "rb") as f:
+            data = ns.parse_trips_response(f.read())
+        self.assertEqual(data["scrollRequestForwardContext"], self.page["scrollRequestForwardContext"])
+        self.assertEqual(data["scrollRequestBackwardContext"], self.page["scrollRequestBackwardContext"])
+        for compact, full in zip(data["trips"], self.page["trips"]):
+            self.assertNotIn("fares", compact)
+            self.assertNotIn("stops", compact["legs"][0])
+            self.assertEqual(ns.Trip(compact).as_dict(), ns.Trip(full).as_dict())
+
+
+class TestBackoff(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = backoff.TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        now[0] = 0.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def test_backoff_delays_grow_up_to_the_cap(self):
+        delays = list(backoff.backoff_delays(6, base=1, cap=4))
+        self.assertEqual(len(delays), 5)
+        for delay, ceiling in zip(delays, [1, 2, 4, 4, 4]):
+            self.assertTrue(0 <= delay <= ceiling)
+
+    def test_retry_stops_at_non_retryable_errors(self):
+        calls = []
+
+        async def call():
+            calls.append(1)
+            raise ns.RequestError("400 Bad Request", 400)
+
+        with self.assertRaises(ns.RequestError):
+            asyncio.run(backoff.retry(call, attempts=3, base=0, retryable=lambda e: e.retryable))
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_gives_up_when_asked_to_wait_longer_than_the_cap(self):
+        calls = []
+
+        async def call():
+            calls.append(1)
+            raise ns.classify_response(429, "Too Many Requests", "600")
+
+        async def run():
+            with self.assertRaises(ns.RateLimited):
+                await asyncio.wait_for(backoff.retry(call, attempts=3, base=0, cap=8,
+                                                     retryable=lambda e: e.retryable), 1)
+
+        asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+
+    def test_priority_limiter_admits_lowest_priority_first(self):
+        limiter = backoff.PriorityLimiter(1)
+        order = []
+
+        async def fetch(name, priority):
+            async with limiter.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        async def run():
+            await limiter.acquire()
+            tasks = [asyncio.create_task(fetch(name, priority))
+                     for name, priority in [("low", 1), ("high", 0), ("low again", 1)]]
+            await asyncio.sleep(0)
+            limiter.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        self.assertEqual(order, ["high", "low", "low again"])
+        self.assertEqual(limiter.active, 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_is_rendered_cumulatively(self):
+        histogram = metrics.Histogram("fetch_seconds", "Fetch time", buckets=(0.1, 1), register=False)
+        histogram.observe(0.05, pair="laa-asdz", page=1)
+        histogram.observe(0.5, pair="laa-asdz", page=1)
+        self.assertEqual(histogram.render().splitlines(), [
+            "# HELP fetch_seconds Fetch time",
+            "# TYPE fetch_seconds histogram",
+            'fetch_seconds_bucket{page="1",pair="laa-asdz",le="0.1"} 1',
+            'fetch_seconds_bucket{page="1",pair="laa-asdz",le="1"} 2',
+            'fetch_seconds_bucket{page="1",pair="laa-asdz",le="+Inf"} 2',
+            'fetch_seconds_sum{page="1",pair="laa-asdz"} 0.55',
+            'fetch_seconds_count{page="1",pair="laa-asdz"} 2',
+        ])
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter("errors_total", "Errors", register=False)
+        counter.inc(error='say "hi"\n')
+        self.assertIn('errors_total{error="say \\"hi\\"\\n"} 1', counter.render())
+
+    def test_cache_lookups_are_counted(self):
+        @ns.async_lru_cache(maxsize=1)
+        async def counted_fetch(key):
+            return key
+
+        async def run():
+            for key in ("a", "a", "b"):
+                await counted_fetch(key)
+
+        asyncio.run(run())
+        labels = (("cache", "counted_fetch"),)
+        self.assertEqual(metrics.cache_hits.values[labels], 1)
+        self.assertEqual(metrics.cache_misses.values[labels], 2)
+        self.assertEqual(metrics.cache_evictions.values[labels], 1)
+
+
+class TestProfiling(unittest.TestCase):
+    def run_profiled(self, profiler, times):
+        async def run():
+            for _ in range(times):
+                async with profiler.profile("refresh"):
+                    [str(i) for i in range(1000)]
+                    await asyncio.sleep(0)
+
+        asyncio.run(run())
+
+    def test_reports_are_written_within_the_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.run_profiled(profiling.Profiler(directory, enabled=True, max_per_hour=2), times=3)
+            files = sorted(os.listdir(directory))
+            self.assertEqual([f.rsplit(".", 1)[1] for f in files], ["prof", "txt", "prof", "txt"])
+            with open(os.path.join(directory, files[1])) as f:
+                report = f.read()
+            self.assertIn("Ordered by: cumulative time", report)
+            self.assertIn("allocations by line", report)
+
+    def test_disabled_profiler_writes_nothing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.run_profiled(profiling.Profiler(directory), times=1)
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.dict(startup.phases, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_view_is_imported_once_on_first_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "lazy_view.py"), "w") as f:
+                f.write("loads = [1]\n")
+            sys.path.insert(0, directory)
+            self.addCleanup(sys.path.remove, directory)
+            self.addCleanup(sys.modules.pop, "lazy_view", None)
+
+            self.assertNotIn("lazy_view", sys.modules)
+            startup.load_view("lazy_view")
+            sys.modules["lazy_view"].loads.append(2)
+            startup.load_view("lazy_view")
+            self.assertEqual(sys.modules["lazy_view"].loads, [1, 2])
+            self.assertEqual(list(startup.phases), ["import lazy_view"])
+
+    def test_report_publishes_phases(self):
+        with startup.timed("open NS session"):
+            pass
+        with startup.timed("open NS session"):
+            pass
+        with self.assertLogs("startup") as logs:
+            startup.report("Started")
+        self.assertIn("open NS session", logs.output[0])
+        seconds = metrics.startup_seconds.values[(("phase", "open NS session"),)]
+        self.assertEqual(seconds, startup.phases["open NS session"])
+
+
+class TestAsyncLruCache(unittest.TestCase):
+    def test_concurrent_callers_share_one_call(self):
+        calls = []
+
+        @ns.async_lru_cache(maxsize=4)
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return [key]
+
+        async def run():
+            return await asyncio.gather(*(fetch("a") for _ in range(5)))
+
+        results = asyncio.run(run())
+        self.assertEqual(calls, ["a"])
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_peek_returns_cached_results_without_calling(self):
+        calls = []
+
+        @ns.async_lru_cache(maxsize=4, ttl=0)
+        async def fetch(key):
+            calls.append(key)
+            return [key]
+
+        self.assertIsNone(fetch.peek("a"))
+        result = asyncio.run(fetch("a"))
+        # Expired entries are still returned
+        self.assertIs(fetch.peek("a"), result)
+        self.assertEqual(calls, ["a"])
+
+    def test_errors_propagate_and_are_not_cached(self):
+        calls = []
+
+        @ns.async_lru_cache(maxsize=4)
+        async def fetch(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            raise ValueError(key)
+
+        async def run():
+            return await asyncio.gather(fetch("a"), fetch("a"), return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        asyncio.run(run())
+        self.assertEqual(calls, ["a", "a"])
+
+    def test_errors_carry_the_last_good_value(self):
+        results = [["good"], ValueError("down")]
+
+        @ns.async_lru_cache(maxsize=4, ttl=0)
+        async def fetch(key):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(asyncio.run(fetch("a")), ["good"])
+        with self.assertRaises(ValueError) as raised:
+            asyncio.run(fetch("a"))
+        self.assertEqual(raised.exception.stale, ["good"])
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        @ns.async_lru_cache(maxsize=4)
+        async def fetch(key):
+            await asyncio.sleep(0.02)
+            return key
+
+        async def run():
+            first = asyncio.create_task(fetch("a"))
+            second = asyncio.create_task(fetch("a"))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            return await second, first.cancelled()
+
+        self.assertEqual(asyncio.run(run()), ("a", True))
+
+    def test_stale_entry_is_served_while_revalidating(self):
+        calls = []
+
+        @ns.async_lru_cache(maxsize=4, ttl=10, stale_ttl=100)
+        async def fetch(key):
+            calls.append(key)
+            return len(calls)
+
+        async def run():
+            with patch('ns.time.time', return_value=1000):
+                first = await fetch("a")
+                cached = await fetch("a")
+            with patch('ns.time.time', return_value=1050):
+                stale = await fetch("a")
+                await asyncio.sleep(0.01)
+                fresh = await fetch("a")
+            with patch('ns.time.time', return_value=2000):
+                expired = await fetch("a")
+            return first, cached, stale, fresh, expired
+
+        self.assertEqual(asyncio.run(run()), (1, 1, 1, 2, 3))
+
+    def test_ttl_callable_receives_call_arguments(self):
+        @ns.async_lru_cache(maxsize=4, ttl=lambda key: 0 if key == "short" else 60)
+        async def fetch(key):
+            return object()
+
+        async def run():
+            return (await fetch("short") is await fetch("short"),
+                    await fetch("long") is await fetch("long"))
+
+        self.assertEqual(asyncio.run(run()), (False, True))
+
+    def test_store_warms_a_fresh_cache(self):
+        calls = []
+
+        async def fetch(key):
+            calls.append(key)
+            return {"trips": [key]}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = persistence.SqliteStore(os.path.join(tmp, "cache.sqlite"))
+
+            async def run():
+                before_restart = ns.async_lru_cache(ttl=60, store=store)(fetch)
+                first = await before_restart("a")
+                await asyncio.sleep(0.05)
+                after_restart = ns.async_lru_cache(ttl=60, store=store)(fetch)
+                return first, await after_restart("a")
+
+            first, second = asyncio.run(run())
+            store.close()
+
+        self.assertEqual(first, second)
+        self.assertEqual(calls, ["a"])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Column-oriented trip table shared by the views."""
+from array import array
+
+
+class TripTable:
+    """Trips stored column by column, built once per fetch.
+
+    Times are epoch seconds in arrays, stations and statuses are stored as
+    small integer codes. Sort orders are computed up front, and station and
+    status filters are evaluated with bytes.translate, so the views get
+    filtered, sorted rows without walking Trip objects per request.
+    A stale table was built from the last good data after a failed fetch.
+    """
+
+    def __init__(self, trips, version=0, changes=None, stale=False):
+        self.trips = list(trips)
+        self.version = version
+        self.changes = changes
+        self.stale = stale
+
+        self.stations = sorted({t.origin for t in self.trips} | {t.destination for t in self.trips})
+        station_codes = {s: i for i, s in enumerate(self.stations)}
+        self.statuses = sorted({t.status for t in self.trips})
+        status_codes = {s: i for i, s in enumerate(self.statuses)}
+
+        self.origin = bytes(station_codes[t.origin] for t in self.trips)
+        self.destination = bytes(station_codes[t.destination] for t in self.trips)
+        self.status = bytes(status_codes[t.status] for t in self.trips)
+
+        self.departure = array("q", (int(t.departure_time.timestamp()) for t in self.trips))
+        self.arrival = array("q", (int(t.arrival_time.timestamp()) for t in self.trips))
+        self.leave_by = array("q", (int(t.leave_by.timestamp()) for t in self.trips))
+        self.arrive_by = array("q", (int(t.arrive_by.timestamp()) for t in self.trips))
+
+        rows = range(len(self.trips))
+        self.orders = {
+            "departure": array("I", sorted(rows, key=lambda i: self.departure[i])),
+            "arrival": array("I", sorted(rows, key=lambda i: self.arrival[i])),
+            "leave_by": array("I", sorted(rows, key=lambda i: self.leave_by[i])),
+            "arrive_by": array("I", sorted(rows, key=lambda i: self.arrive_by[i])),
+        }
+
+    def __len__(self):
+        return len(self.trips)
+
+    def __iter__(self):
+        return iter(self.trips)
+
+    @staticmethod
+    def _lookup(codes, allowed):
+        """Translation table mapping each code to 1 if allowed, else 0."""
+        table = bytearray(256)
+        for i, value in enumerate(codes):
+            if value in allowed:
+                table[i] = 1
+        return bytes(table)
+
+    def mask(self, origins=None, destinations=None, statuses=None):
+        """Return a bytes mask with 1 for every row matching all given filters."""
+        mask = b"\x01" * len(self.trips)
+        filters = (
+            (self.origin, self.stations, origins),
+            (self.destination, self.stations, destinations),
+            (self.status, self.statuses, statuses),
+        )
+        for column, codes, allowed in filters:
+            if allowed is None:
+                continue
+            selected = column.translate(self._lookup(codes, set(allowed)))
+            mask = (int.from_bytes(mask, "big") & int.from_bytes(selected, "big")).to_bytes(len(mask), "big")
+        return mask
+
+    def select(self, station_selection=None, order="departure", statuses=None):
+        """Return trips between selected stations, sorted by the given column.
+
+        Args:
+            station_selection: Mapping of station code to bool, as kept in user storage
+            order: One of departure, arrival, leave_by, arrive_by
+            statuses: Optional collection of statuses to keep
+        """
+        stations = None
+        if station_selection is not None:
+            stations = [s for s, selected in station_selection.items() if selected]
+        mask = self.mask(origins=stations, destinations=stations, statuses=statuses)
+        return [self.trips[i] for i in self.orders[order] if mask[i]]
+
+    def group_by(self, column, station_selection=None, order="departure"):
+        """Return selected trips grouped by origin or destination station, sorted by station."""
+        groups = {}
+        for trip in self.select(station_selection, order):
+            groups.setdefault(getattr(trip, column), []).append(trip)
+        return dict(sorted(groups.items()))
@@ -3,8 +3,13 @@ from datetime import datetime, timedelta
 from nicegui import ui, app
 import ns
 import logging
+import time
 import storage
 import icons
+import hub
+import metrics
+import prefetch
+import fragments
 
 # Configure logging
 logging.basicConfig(
@@ -49,6 +54,16 @@ columns = [{"name": c, "label": l, "field": c}
            for c, l in zip(columns_order, labels)]
 
 
+def format_value(v):
+    """Format datetimes and timedeltas as HH:MM, anything else as str."""
+    return v.strftime("%H:%M") if isinstance(v, datetime) else (datetime.min + v).strftime("%H:%M") if isinstance(v, timedelta) else str(v)
+
+
+def serialize(trips):
+    """Return table rows of trips: their uid and the columns_order fields."""
+    return [{"uid": t.uid, **{c: format_value(getattr(t, c)) for c in columns_order}} for t in trips]
+
+
 @ui.page("/v1/trains")
 async def v1_trains_index():
     logger.info("Rendering v1 trains index page")
@@ -71,8 +86,10 @@ async def v1_trains_where(where: str):
 @ui.page("/v1/trains/{where}/{hour}")
 async def v1_trains_where_hour(where: str, hour: int):
     logger.info(f"Rendering v1 trains page for {where} at hour {hour}")
+    prefetch.record(where, hour)
     # already display page once client websocket is connected
     await ui.context.client.connected()
+    render_start = time.perf_counter()
 
     # Initialize storage
     storage.init_storage()
@@ -86,8 +103,8 @@ async def v1_trains_where_hour(where: str, hour: int):
     date_time = ns.get_amsterdam_time(hour)
     logger.info(f"Fetching trips for {date_time}")
 
-    # get trips async
-    trips = await ns.get_trips(where, date_time)
+    # get trips async; every pair is fetched, as the checkboxes filter rows in the browser
+    trips = await ns.get_trip_table(where, date_time)
     spinner.visible = False
     logger.info(f"Retrieved {len(trips)} trips")
 
@@ -95,16 +112,13 @@ async def v1_trains_where_hour(where: str, hour: int):
     spinner.visible = False
     label.set_text(f"Found {len(trips)} trips at {date_time.strftime('%H:%M')}")
 
-    # serialize trips, format datetimes
-    rows = [
-        {
-            k: v.strftime("%H:%M") if isinstance(v, datetime) else (datetime.min + v).strftime("%H:%M") if isinstance(v, timedelta) else str(v)
-            for k, v in vars(t).items()
-        }
-        for t in trips
-    ]
+    # Rows do not depend on the station selection, which is applied in the browser
+    rows = fragments.get('v1', where, date_time, None, trips, lambda: serialize(trips))
 
-    # build and display table
+    # build and display table, filtered by station in the browser; the
+    # filter is the user's station selection itself, so it is current
+    # whenever the table is sent again
+    station_selection = app.storage.user['station_selection']
     table = ui.table(
         columns=columns,
         rows=rows,
@@ -113,8 +127,10 @@ async def v1_trains_where_hour(where: str, hour: int):
             "headerClasses": "uppercase text-primary",
             "sortable": True,
         },
-        row_key="name",
+        row_key="uid",
     )
+    table._props["filter"] = station_selection
+    table.props(':filter-method="(rows, terms) => rows.filter(row => terms[row.origin] && terms[row.destination])"')
 
     # add table header
     table.add_slot(
@@ -128,26 +144,26 @@ async def v1_trains_where_hour(where: str, hour: int):
         """,
     )
 
-    # Update label and filter rows
+    # Update label
     now = date_time.strftime("%H:%M")
-    station_selection = app.storage.user['station_selection']
+    # Whether the trips shown are the last good data after a failed fetch
+    stale = {'value': trips.stale}
     def update_label():
-        filtered_rows = [
-            row for row in rows
-            if station_selection[row['origin']] and station_selection[row['destination']]
-        ]
-        table.rows = filtered_rows
-        label.set_text(f"Found {len(filtered_rows)} trips at {now}")
-
-    # Add station selection checkboxes
+        count = sum(1 for row in table.rows if station_selection[row['origin']] and station_selection[row['destination']])
+        label.set_text(f"Found {count} trips at {now}{' (stale)' if stale['value'] else ''}")
+
+    # Add station selection checkboxes, toggling the table filter in the browser
     with ui.row().classes('w-full justify-left gap-4 mb-4'):
-        station_selection = app.storage.user['station_selection']
         for station_code, station in ns.stations.items():
             checkbox = ui.checkbox(
                 station_code.upper(),
                 value=station_selection[station_code]
             ).classes('text-base')
             checkbox.bind_value(app.storage.user['station_selection'], station_code)
+            checkbox.on('update:model-value', js_handler=f'''(value) => {{
+                const props = mounted_app.elements[{table.id}].props;
+                props.filter = {{...props.filter, {station_code}: value}};
+            }}''')
             checkbox.on('change', update_label)
 
         # Add refresh link
@@ -157,8 +173,26 @@ async def v1_trains_where_hour(where: str, hour: int):
     # Initial label update
     update_label()
 
+    # The client may have gone while the trips were fetched, running its
+    # delete handlers before this page could register one
+    if ui.context.client._deleted:
+        return
+
+    # Push trip changes to this page until the client goes away
+    def on_trips_changed(trips, changes):
+        logger.info(f"Applying pushed changes to v1 page for {where} at hour {hour}: {changes}")
+        table.rows = fragments.get('v1', where, date_time, None, trips, lambda: serialize(trips))
+        stale['value'] = trips.stale
+        update_label()
+
+    subscription = hub.subscribe(where, date_time, on_trips_changed, version=trips.version)
+    ui.context.client.on_delete(lambda: hub.unsubscribe(subscription))
+
     # add back link
     with ui.row():
         ui.link("🫵", "/v1/trains")
         ui.link("➖", f"/v1/trains/{where}/{hour - 1}")
-        ui.link("➕", f"/v1/trains/{where}/{hour + 1}")
\ No newline at end of file
+        ui.link("➕", f"/v1/trains/{where}/{hour + 1}")
+
+    metrics.render_seconds.observe(time.perf_counter() - render_start, view="v1")
+    metrics.page_elements.observe(len(ui.context.client.elements), view="v1")
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
+from html import escape
 from nicegui import ui, app
+import os
 import ns
 import logging
+import time
 import icons
+import hub
+import metrics
+import prefetch
+import profiling
+import fragments
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +34,67 @@ def format_timedelta(td) -> str:
     return str(td)
 
 
+# Maximum number of trip cards on a page; each card is a single element
+ELEMENT_BUDGET = int(os.getenv("STATIONATOR_V2_ELEMENT_BUDGET", "200"))
+
+STATUS_COLORS = {
+    'NORMAL': 'text-green-600',
+    'CANCELLED': 'text-red-600',
+    'DELAYED': 'text-yellow-600'
+}
+
+
+def card_html(trip) -> str:
+    """Return the markup of one trip card.
+
+    Cards are sent as a single HTML element rather than a tree of rows,
+    columns and labels, so a page holds one element per trip.
+    """
+    def line(text, classes):
+        return f'<div class="nicegui-label {classes}">{escape(text)}</div>'
+
+    def column(classes, *lines):
+        return f'<div class="nicegui-column {classes}">{"".join(lines)}</div>'
+
+    def row(classes, *columns):
+        return f'<div class="nicegui-row {classes}">{"".join(columns)}</div>'
+
+    travel_time = format_timedelta(trip.travel_time)
+    return f'''<div class="q-card__section q-card__section--vert flex flex-col gap-1 p-2 sm:p-3">{
+        row('justify-between items-center gap-1 sm:gap-2',
+            column('items-start w-[100px] sm:w-[120px]',
+                   line(f"🕗 {format_timedelta(trip.departure_time)}", 'text-base sm:text-lg font-bold'),
+                   line(f"🛫 {trip.origin.upper()}", 'text-sm sm:text-base'),
+                   line(f"🚉 {trip.departure_track}", 'text-xs text-gray-600') if trip.departure_track else ''),
+            column('items-center hidden sm:flex w-[60px]',
+                   column('items-center gap-1',
+                          line("→", 'text-lg sm:text-xl'),
+                          line(f"⏱️ {travel_time}", 'text-xs text-gray-600'))),
+            column('items-end w-[100px] sm:w-[120px]',
+                   line(f"{format_timedelta(trip.arrival_time)} 🕓", 'text-base sm:text-lg font-bold'),
+                   line(f"{trip.destination.upper()} 🛬", 'text-sm sm:text-base'),
+                   line(f"{trip.arrival_track} 🚉", 'text-xs text-gray-600') if trip.arrival_track else ''))
+    }{
+        row('sm:hidden justify-center items-center gap-1 mt-1 pt-1 border-t',
+            line("→", 'text-lg'),
+            line(f"⏱️ {travel_time}", 'text-xs text-gray-600'))
+    }{
+        row('justify-between items-center mt-1 pt-1 border-t gap-1 sm:gap-2',
+            column('items-start w-[120px] sm:w-[140px]',
+                   line(f"🚀 {format_timedelta(trip.leave_by)}", 'text-xs'),
+                   line(f"🚴 {format_timedelta(trip.biking_time)}", 'text-xs')),
+            column('items-end w-[120px] sm:w-[140px]',
+                   line(f"{format_timedelta(trip.arrive_by)} 😰", 'text-xs'),
+                   line(f"{format_timedelta(trip.train_time)} 💺", 'text-xs')))
+    }{
+        row('justify-between items-center mt-1 pt-1 border-t gap-1 sm:gap-2',
+            column('items-start w-[120px] sm:w-[140px]',
+                   line(f"🏁 {trip.direction}", 'text-xs text-gray-600') if trip.direction else ''),
+            column('items-end w-[120px] sm:w-[140px]',
+                   line(f"{trip.status} ☠️", f"text-xs {STATUS_COLORS.get(trip.status, 'text-gray-600')}")))
+    }</div>'''
+
+
 @ui.page("/v2/trains")
 async def v2_trains_index():
     logger.info("Rendering v2 trains index page")
@@ -48,12 +117,17 @@ async def v2_trains_where(where: str):
 @ui.page("/v2/trains/{where}/{hour}")
 async def v2_trains_where_hour(where: str, hour: int):
     logger.info(f"Rendering v2 trains page for {where} at hour {hour}")
+    prefetch.record(where, hour)
     # already display page once client websocket is connected
     await ui.context.client.connected()
+    render_start = time.perf_counter()
 
     # Initialize storage
     import storage
     storage.init_storage()
+    # The user's station selection, read here since trip changes are
+    # pushed outside of this request; checkboxes update it in place
+    station_selection = app.storage.user['station_selection']
 
     # Create a container for the cards
     container = ui.column().classes('w-full items-center gap-1 sm:gap-2 px-1 sm:px-4')
@@ -61,6 +135,95 @@ async def v2_trains_where_hour(where: str, hour: int):
     # Create a container for the trips
     trips_container = ui.column().classes('w-full items-center gap-1 sm:gap-2')
 
+    # Rendered cards by trip uid, station columns, and page state shared by the render functions
+    cards = {}
+    columns = {}
+    page = {}
+
+    def get_card(trip):
+        """Return the markup of a trip card, shared with other viewers of these trips."""
+        # Cards do not depend on the station selection, only on which cards are drawn
+        cards_html = fragments.get('v2', where, page['date_time'], None, page['trips'], dict)
+        if trip.uid not in cards_html:
+            cards_html[trip.uid] = card_html(trip)
+        return cards_html[trip.uid]
+
+    def render_trips(trips):
+        """Draw the trip cards grouped by station into the trips container."""
+        trips_container.clear()
+        cards.clear()
+        columns.clear()
+
+        # Update label
+        now = page['date_time'].strftime("%H:%M")
+        page['label'].set_text(f"{'🏠' if where == 'home' else '💼'} {len(trips)} trips at {now}{' (stale)' if trips.stale else ''}")
+
+        # Group trips by station (origin for work, destination for home)
+        # Skip trips where either origin or destination is not selected
+        trips_by_station = trips.group_by("destination" if where == "home" else "origin", station_selection)
+        page['groups'] = {station: [t.uid for t in group] for station, group in trips_by_station.items()}
+
+        # Sort stations alphabetically
+        sorted_stations = sorted(trips_by_station.keys())
+        logger.info(f"Grouped trips by {len(sorted_stations)} stations: {sorted_stations}")
+
+        # Share the card budget between the station columns, keeping columns the user expanded
+        shown_stations = [station for station in sorted_stations if station_selection[station]]
+        per_station = max(1, ELEMENT_BUDGET // max(1, len(shown_stations)))
+        limits = page.get('limits', {})
+        page.update(trips_by_station=trips_by_station, per_station=per_station,
+                    limits={station: max(per_station, limits.get(station, 0)) for station in shown_stations})
+
+        # Create columns for each station
+        with trips_container:
+            with ui.row().classes('w-full max-w-3xl gap-2 sm:gap-4 justify-center flex-wrap'):
+                for station in shown_stations:
+                    columns[station] = ui.column().classes('items-center')
+                    render_station(station)
+
+    def render_station(station):
+        """Draw a station column with at most its limit of cards, and a button for the rest."""
+        station_trips = page['trips_by_station'][station]
+        limit = page['limits'][station]
+        column = columns[station]
+        for trip in station_trips:
+            cards.pop(trip.uid, None)
+        column.clear()
+        with column:
+            # Station header
+            station_type = "🛬" if where == "home" else "🛫"
+            ui.label(f"{station_type} {station.upper()}").classes('text-base sm:text-lg font-bold mb-1')
+
+            # Cards for this station
+            for trip in station_trips[:limit]:
+                cards[trip.uid] = ui.html(get_card(trip), sanitize=False).classes('q-card mb-1 sm:mb-2')
+            if len(station_trips) > limit:
+                ui.button(f"{len(station_trips) - limit} more", on_click=lambda: show_more(station)) \
+                    .props('flat dense no-caps')
+
+    def show_more(station):
+        """Draw the next budget's worth of cards of a station."""
+        page['limits'][station] += page['per_station']
+        render_station(station)
+
+    def on_trips_changed(trips, changes):
+        """Apply trip changes pushed by the hub, redrawing only the cards that changed."""
+        logger.info(f"Applying pushed changes to v2 page for {where} at hour {hour}: {changes}")
+        page['trips'] = trips
+        trips_by_station = trips.group_by("destination" if where == "home" else "origin", station_selection)
+        groups = {station: [t.uid for t in group] for station, group in trips_by_station.items()}
+        # New, removed or reordered trips need the cards to be laid out again
+        if changes.added or changes.removed or groups != page.get('groups'):
+            render_trips(trips)
+            return
+        page['trips_by_station'] = trips_by_station
+        trips_by_uid = {trip.uid: trip for trip in trips}
+        for uid in changes.updated:
+            card = cards.get(uid)
+            if card is not None:
+                card.set_content(get_card(trips_by_uid[uid]))
+
+    @profiling.profiled("v2-refresh_trips")
     async def refresh_trips():
         """Fetch and display trips."""
         # Clear existing trips
@@ -78,7 +241,6 @@ async def v2_trains_where_hour(where: str, hour: int):
 
                 # Center: Station selection
                 with ui.row().classes('items-center gap-2 sm:gap-3'):
-                    station_selection = app.storage.user['station_selection']
                     for station_code, station in ns.stations.items():
                         checkbox = ui.checkbox(
                             station_code.upper(),
@@ -97,99 +259,30 @@ async def v2_trains_where_hour(where: str, hour: int):
 
         # set time
         date_time = ns.get_amsterdam_time(hour)
+        page.update(date_time=date_time, label=label)
         logger.info(f"Fetching trips for {date_time}")
 
         # get trips async
-        trips = await ns.get_trips(where, date_time)
+        # Pairs outside the selection are fetched once selected and refreshed
+        trips = await ns.get_trip_table(where, date_time, station_selection)
+        page['trips'] = trips
         spinner.visible = False
         logger.info(f"Retrieved {len(trips)} trips")
 
-        # Update label
-        now = date_time.strftime("%H:%M")
-        label.set_text(f"{'🏠' if where == 'home' else '💼'} {len(trips)} trips at {now}")
+        render_trips(trips)
 
-        # Group trips by station (origin for work, destination for home)
-        station_selection = app.storage.user['station_selection']
-        trips_by_station = {}
-        for trip in trips:
-            # Skip trips where either origin or destination is not selected
-            if not station_selection[trip.origin] or not station_selection[trip.destination]:
-                continue
-
-            station = trip.destination if where == "home" else trip.origin
-            if station not in trips_by_station:
-                trips_by_station[station] = []
-            trips_by_station[station].append(trip)
+    # Initial load of trips
+    await refresh_trips()
 
-        # Sort stations alphabetically
-        sorted_stations = sorted(trips_by_station.keys())
-        logger.info(f"Grouped trips by {len(sorted_stations)} stations: {sorted_stations}")
+    # The client may have gone while the trips were fetched, running its
+    # delete handlers before this page could register one
+    if ui.context.client._deleted:
+        return
 
-        # Create columns for each station
-        with trips_container:
-            with ui.row().classes('w-full max-w-3xl gap-2 sm:gap-4 justify-center flex-wrap'):
-                for station in sorted_stations:
-                    # Skip stations that are not selected
-                    if not station_selection[station]:
-                        continue
-
-                    with ui.column().classes('items-center'):
-                        # Station header
-                        station_type = "🛬" if where == "home" else "🛫"
-                        ui.label(f"{station_type} {station.upper()}").classes('text-base sm:text-lg font-bold mb-1')
-
-                        # Cards for this station
-                        for trip in trips_by_station[station]:
-                            with ui.card().classes('mb-1 sm:mb-2'):
-                                with ui.card_section().classes('flex flex-col gap-1 p-2 sm:p-3'):
-                                    # Main journey info
-                                    with ui.row().classes('justify-between items-center gap-1 sm:gap-2'):
-                                        # Departure info
-                                        with ui.column().classes('items-start w-[100px] sm:w-[120px]'):
-                                            ui.label(f"🕗 {format_timedelta(trip.departure_time)}").classes('text-base sm:text-lg font-bold')
-                                            ui.label(f"🛫 {trip.origin.upper()}").classes('text-sm sm:text-base')
-                                            if trip.departure_track:
-                                                ui.label(f"🚉 {trip.departure_track}").classes('text-xs text-gray-600')
-
-                                        # Journey info
-                                        with ui.column().classes('items-center hidden sm:flex w-[60px]'):
-                                            with ui.column().classes('items-center gap-1'):
-                                                ui.label("→").classes('text-lg sm:text-xl')
-                                                ui.label(f"⏱️ {format_timedelta(trip.travel_time)}").classes('text-xs text-gray-600')
-
-                                        # Arrival info
-                                        with ui.column().classes('items-end w-[100px] sm:w-[120px]'):
-                                            ui.label(f"{format_timedelta(trip.arrival_time)} 🕓").classes('text-base sm:text-lg font-bold')
-                                            ui.label(f"{trip.destination.upper()} 🛬").classes('text-sm sm:text-base')
-                                            if trip.arrival_track:
-                                                ui.label(f"{trip.arrival_track} 🚉").classes('text-xs text-gray-600')
-
-                                    # Travel time for mobile
-                                    with ui.row().classes('sm:hidden justify-center items-center gap-1 mt-1 pt-1 border-t'):
-                                        ui.label("→").classes('text-lg')
-                                        ui.label(f"⏱️ {format_timedelta(trip.travel_time)}").classes('text-xs text-gray-600')
-
-                                    # Additional journey details
-                                    with ui.row().classes('justify-between items-center mt-1 pt-1 border-t gap-1 sm:gap-2'):
-                                        with ui.column().classes('items-start w-[120px] sm:w-[140px]'):
-                                            ui.label(f"🚀 {format_timedelta(trip.leave_by)}").classes('text-xs')
-                                            ui.label(f"🚴 {format_timedelta(trip.biking_time)}").classes('text-xs')
-                                        with ui.column().classes('items-end w-[120px] sm:w-[140px]'):
-                                            ui.label(f"{format_timedelta(trip.arrive_by)} 😰").classes('text-xs')
-                                            ui.label(f"{format_timedelta(trip.train_time)} 💺").classes('text-xs')
-
-                                    # Status and direction indicator
-                                    with ui.row().classes('justify-between items-center mt-1 pt-1 border-t gap-1 sm:gap-2'):
-                                        with ui.column().classes('items-start w-[120px] sm:w-[140px]'):
-                                            if trip.direction:
-                                                ui.label(f"🏁 {trip.direction}").classes('text-xs text-gray-600')
-                                        with ui.column().classes('items-end w-[120px] sm:w-[140px]'):
-                                            status_color = {
-                                                'NORMAL': 'text-green-600',
-                                                'CANCELLED': 'text-red-600',
-                                                'DELAYED': 'text-yellow-600'
-                                            }.get(trip.status, 'text-gray-600')
-                                            ui.label(f"{trip.status} ☠️").classes(f'text-xs {status_color}')
+    # Push trip changes to this page until the client goes away
+    subscription = hub.subscribe(where, page['date_time'], on_trips_changed, version=page['trips'].version,
+                                 station_selection=station_selection)
+    ui.context.client.on_delete(lambda: hub.unsubscribe(subscription))
 
-    # Initial load of trips
-    await refresh_trips()
\ No newline at end of file
+    metrics.render_seconds.observe(time.perf_counter() - render_start, view="v2")
+    metrics.page_elements.observe(len(ui.context.client.elements), view="v2")
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
-from datetime import datetime, timedelta
 from nicegui import ui, app
 import ns
 import logging
+import time
 import storage
 import icons
-import asyncio
+import hub
+import metrics
+import prefetch
+import profiling
+import fragments
+from gantt import Gantt
 
 # Configure logging
 logging.basicConfig(
@@ -16,36 +21,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def format_timedelta(td) -> str:
-    """Convert timedelta or datetime to HH:MM format string."""
-    if isinstance(td, datetime):
-        return td.strftime("%H:%M")
-    elif isinstance(td, timedelta):
-        total_seconds = int(td.total_seconds())
-        hours = total_seconds // 3600
-        minutes = (total_seconds % 3600) // 60
-        return f"{hours:02d}:{minutes:02d}"
-    return str(td)
-
-
-def format_minutes(minutes: int) -> str:
-    """Format minutes as 'h:min' if >= 1 hour, or just 'min' if < 1 hour.
-
-    Preserves original sign behavior: '-' prefix for future (>=0), '+' prefix for past (<0).
-    """
-    abs_minutes = abs(minutes)
-    if abs_minutes >= 60:
-        hours = abs_minutes // 60
-        mins = abs_minutes % 60
-        formatted = f"{hours}h {mins:02d}m"
-    else:
-        formatted = str(abs_minutes) + "m"
-
-    # Preserve original sign behavior: '-' for future (>=0), '+' for past (<0)
-    if minutes >= 0:
-        return f"-{formatted}"
-    else:
-        return f"+{formatted}"
+# Classes highlighting the selected trip row
+SELECTED_ROW_CLASSES = 'bg-blue-50 rounded p-1'
 
 
 @ui.page("/v3/trains")
@@ -70,45 +47,51 @@ async def v3_trains_where(where: str):
 @ui.page("/v3/trains/{where}/{hour}")
 async def v3_trains_where_hour(where: str, hour: int):
     logger.info(f"Rendering v3 trains page for {where} at hour {hour}")
+    prefetch.record(where, hour)
     # already display page once client websocket is connected
     await ui.context.client.connected()
+    render_start = time.perf_counter()
 
     # Initialize storage
     storage.init_storage()
+    # The user's station selection, read here since trip changes are
+    # pushed outside of this request; checkboxes update it in place
+    station_selection = app.storage.user['station_selection']
 
     # Create a container for the page
     container = ui.column().classes('w-full items-center gap-2 px-2 sm:px-4')
 
-    # Track selected trip index
-    selected_trip_index = {'value': None}
+    def get_chart(trips):
+        """Return the Gantt rows of the selected trips, shared with other viewers of this page."""
+        # Filter trips based on station selection, sorted by arrival_time
+        return fragments.get('v3', where, page['date_time'], station_selection, trips,
+                             lambda: Gantt.chart(trips.select(station_selection, order="arrival")))
 
-    def get_trip_id(trip) -> str:
-        """Generate a unique, stable ID for a trip based on its key attributes."""
-        dep_time_str = trip.departure_time.strftime("%H%M")
-        return f"trip-{trip.origin}-{trip.destination}-{dep_time_str}"
+    def render_chart(trips):
+        """Send the selected trips to the Gantt chart."""
+        chart = get_chart(trips)
 
-    async def scroll_to_anchor_if_present():
-        """Scroll to anchor in URL if present."""
-        await asyncio.sleep(0.3)  # Wait for rendering
-        ui.run_javascript('''
-            const hash = window.location.hash.substring(1);
-            if (hash) {
-                const element = document.getElementById(hash);
-                if (element) {
-                    setTimeout(() => {
-                        element.scrollIntoView({behavior: "smooth", block: "center"});
-                        // Find the trip index and select it
-                        const tripRows = document.querySelectorAll('[id^="trip-"]');
-                        tripRows.forEach((row, idx) => {
-                            if (row.id === hash) {
-                                row.click();
-                            }
-                        });
-                    }, 100);
-                }
-            }
-        ''')
+        # Update trip count label
+        now = page['date_time'].strftime("%H:%M")
+        page['trip_count_label'].set_text(f"{len(chart['uids'])} trips at {now}{' (stale)' if trips.stale else ''}")
+
+        page['gantt'].set_chart(chart)
+
+    def on_trips_changed(trips, changes):
+        """Apply trip changes pushed by the hub, redrawing only the rows that changed."""
+        logger.info(f"Applying pushed changes to v3 page for {where} at hour {hour}: {changes}")
+        page['trips'] = trips
+        uids = get_chart(trips)['uids']
+        gantt = page['gantt']
+        # New, removed or reordered trips need all rows to be resent; the
+        # chart rescales itself in the browser
+        if changes.added or changes.removed or uids != gantt.uids:
+            render_chart(trips)
+            return
+        trips_by_uid = {trip.uid: trip for trip in trips}
+        gantt.update_trips([trips_by_uid[uid] for uid in changes.updated if uid in trips_by_uid and uid in uids])
 
+    @profiling.profiled("v3-refresh_trips")
     async def refresh_trips():
         """Fetch and display trips as Gantt chart."""
         container.clear()
@@ -143,7 +126,6 @@ async def v3_trains_where_hour(where: str, hour: int):
 
                 # Second row: Station selection - wrap on mobile
                 with ui.row().classes('w-full items-center gap-1 sm:gap-2 flex-wrap justify-center sm:justify-start'):
-                    station_selection = app.storage.user['station_selection']
                     for station_code, station in ns.stations.items():
                         checkbox = ui.checkbox(
                             station_code.upper(),
@@ -151,194 +133,43 @@ async def v3_trains_where_hour(where: str, hour: int):
                         ).classes('text-xs scale-90 sm:scale-100').style('--q-primary: #003082')
                         checkbox.bind_value(station_selection, station_code)
 
+            # Gantt chart, redrawn without refetching when trips change
+            with ui.column().classes('w-full items-center gap-2'):
+                # Work page: home icon on leave_by, work icon on arrive_by; home page the reverse
+                leave_by_icon, arrive_by_icon = ('work', 'home') if where == 'home' else ('home', 'work')
+                page['gantt'] = Gantt(icons.ns_icon(leave_by_icon, 12), icons.ns_icon(arrive_by_icon, 12),
+                                      selected_classes=SELECTED_ROW_CLASSES)
+            page['trip_count_label'] = trip_count_label
+
         # set time
         date_time = ns.get_amsterdam_time(hour)
+        page['date_time'] = date_time
         logger.info(f"Fetching trips for {date_time}")
 
         # get trips async
-        trips = await ns.get_trips(where, date_time)
+        # Pairs outside the selection are fetched once selected and refreshed
+        trips = await ns.get_trip_table(where, date_time, station_selection)
+        page['trips'] = trips
         spinner.visible = False
         logger.info(f"Retrieved {len(trips)} trips")
 
-        # Filter trips based on station selection
-        station_selection = app.storage.user['station_selection']
-        filtered_trips = [
-            trip for trip in trips
-            if station_selection[trip.origin] and
-               station_selection[trip.destination]
-        ]
-
-        # Sort trips by arrival_time
-        filtered_trips.sort(key=lambda t: t.arrival_time)
-
-        # Update trip count label
-        now = date_time.strftime("%H:%M")
-        trip_count_label.set_text(f"{len(filtered_trips)} trips at {now}")
-
-        if not filtered_trips:
-            with container:
-                ui.label("No trips available").classes('text-lg text-gray-500 mt-4')
-            return
-
-        # Calculate time range for the chart
-        min_time = min(trip.leave_by for trip in filtered_trips)
-        max_time = max(trip.arrive_by for trip in filtered_trips)
-        total_duration = max_time - min_time
-
-        # Create Gantt chart container
-        with container:
-            # Create container for the chart (no horizontal scrolling)
-            chart_container = ui.column().classes('w-full max-w-6xl overflow-x-hidden')
-
-            with chart_container:
-                # Calculate chart width
-                chart_width = max(800, int(total_duration.total_seconds() * 2))  # 2px per second, minimum 800px
-
-                # Calculate current time position
-                current_time = ns.get_amsterdam_time(round_to_hour=False)
-                now_position_percent = 0
-                if min_time <= current_time <= max_time:
-                    now_offset = (current_time - min_time).total_seconds()
-                    now_position_percent = (now_offset / total_duration.total_seconds()) * 100 if total_duration.total_seconds() > 0 else 0
+        render_chart(trips)
 
-                # Gantt chart rows
-                row_height = 35
-                for idx, trip in enumerate(filtered_trips):
-                    trip_id = get_trip_id(trip)
-                    is_selected = selected_trip_index['value'] == idx
-                    row_classes = 'w-full mb-1 items-center cursor-pointer transition-all'
-                    if is_selected:
-                        row_classes += ' bg-blue-50 rounded p-1'
-                    trip_row = ui.row().classes(row_classes)
-                    trip_row.props(f'id="{trip_id}"')
-
-                    def make_click_handler(trip_idx, trip_anchor_id):
-                        async def on_click():
-                            if selected_trip_index['value'] == trip_idx:
-                                selected_trip_index['value'] = None
-                                # Remove anchor from URL
-                                ui.run_javascript(f'history.replaceState(null, "", window.location.pathname)')
-                            else:
-                                selected_trip_index['value'] = trip_idx
-                                # Update URL with anchor
-                                ui.run_javascript(f'history.replaceState(null, "", window.location.pathname + "#{trip_anchor_id}")')
-                                # Scroll to the trip
-                                ui.run_javascript(f'document.getElementById("{trip_anchor_id}").scrollIntoView({{behavior: "smooth", block: "center"}})')
-                            await refresh_trips()
-                        return on_click
-
-                    trip_row.on('click', make_click_handler(idx, trip_id))
-
-                    with trip_row:
-                        # Trip label (left side) - all info on one line
-                        with ui.row().classes('w-[320px] flex-shrink-0 pr-2 items-center gap-1 sm:gap-2 flex-nowrap'):
-                            # Calculate minutes until departure
-                            minutes_until_departure = int((trip.departure_time - current_time).total_seconds() / 60)
-                            # Get biking time for origin station
-                            origin_station = ns.stations.get(trip.origin)
-                            biking_time_minutes = int(origin_station.biking_time.total_seconds() / 60) if origin_station else 15
-                            # Color logic: green if >= biking_time, red if < biking_time, gray if past
-                            if minutes_until_departure < 0:
-                                minutes_label_color = 'text-gray-500'
-                            elif minutes_until_departure >= biking_time_minutes:
-                                minutes_label_color = 'text-green-600 font-semibold'
-                            else:
-                                minutes_label_color = 'text-red-600 font-semibold'
-                            minutes_display = format_minutes(minutes_until_departure)
-
-                            # Order: origin -> destination, status, direction, track number, travel_time, minutes_to_go (right justified)
-                            ui.label(f"{trip.origin.upper()} → {trip.destination.upper()}").classes('text-[10px] sm:text-xs font-bold whitespace-nowrap')
-                            # Status with color coding - always shown
-                            status_color = {
-                                'NORMAL': 'text-green-600 font-semibold',
-                                'CANCELLED': 'text-red-600 font-semibold',
-                                'DELAYED': 'text-yellow-600 font-semibold'
-                            }.get(trip.status, 'text-gray-600')
-                            ui.label(f"{trip.status}").classes(f'text-[10px] sm:text-xs {status_color} whitespace-nowrap')
-                            if trip.direction:
-                                ui.label(f"{trip.direction}").classes('text-[10px] sm:text-xs text-gray-600 whitespace-nowrap')
-                            if trip.departure_track:
-                                ui.label(f"{trip.departure_track}").classes('text-[10px] sm:text-xs text-gray-500 whitespace-nowrap')
-                            ui.label(f"{format_timedelta(trip.travel_time)}").classes('text-[10px] sm:text-xs text-gray-500 whitespace-nowrap')
-                            # Minutes to go - right justified
-                            ui.label(minutes_display).classes(f'text-[10px] sm:text-xs {minutes_label_color} whitespace-nowrap ml-auto')
-
-                        # Gantt bar container
-                        gantt_bar = ui.html('', sanitize=False).style(f'width: {chart_width}px; position: relative;')
-
-                        # Calculate positions and widths
-                        trip_start_offset = (trip.leave_by - min_time).total_seconds()
-                        trip_end_offset = (trip.arrive_by - min_time).total_seconds()
-                        total_trip_duration = (trip.arrive_by - trip.leave_by).total_seconds()
-
-                        start_percent = (trip_start_offset / total_duration.total_seconds()) * 100 if total_duration.total_seconds() > 0 else 0
-                        width_percent = (total_trip_duration / total_duration.total_seconds()) * 100 if total_duration.total_seconds() > 0 else 0
-
-                        # Calculate segments using actual time differences
-                        biking_before_seconds = (trip.departure_time - trip.leave_by).total_seconds()
-                        train_time_seconds = (trip.arrival_time - trip.departure_time).total_seconds()
-                        biking_after_seconds = (trip.arrive_by - trip.arrival_time).total_seconds()
-
-                        biking_before_percent = (biking_before_seconds / total_trip_duration) * 100 if total_trip_duration > 0 else 0
-                        train_percent = (train_time_seconds / total_trip_duration) * 100 if total_trip_duration > 0 else 0
-                        biking_after_percent = (biking_after_seconds / total_trip_duration) * 100 if total_trip_duration > 0 else 0
-
-                        # Format times for display
-                        dep_time_str = format_timedelta(trip.departure_time)
-                        arr_time_str = format_timedelta(trip.arrival_time)
-                        leave_by_str = format_timedelta(trip.leave_by)
-                        arrive_by_str = format_timedelta(trip.arrive_by)
-
-                        # Determine icons based on page context
-                        # Work page: home icon on arrive_by, work icon on leave_by
-                        # Home page: work icon on arrive_by, home icon on leave_by
-                        icon_size = 12
-                        if where == 'home':
-                            leave_by_icon = icons.ns_icon('work', icon_size)
-                            arrive_by_icon = icons.ns_icon('home', icon_size)
-                        else:  # home page
-                            leave_by_icon = icons.ns_icon('home', icon_size)
-                            arrive_by_icon = icons.ns_icon('work', icon_size)
-
-                        # Create Gantt bar HTML
-                        # Add "now" line if current time is within the chart range
-                        now_line_html = ''
-                        if min_time <= current_time <= max_time:
-                            now_line_html = f'<div style="position: absolute; left: {now_position_percent}%; top: 0; width: 2px; height: 100%; background-color: #f44336; z-index: 10;" title="Now"></div>'
-
-                        border_color = '#003082' if is_selected else '#003082'
-                        border_width = '3px' if is_selected else '1px'
-                        gantt_html = f'''
-                            <div style="position: relative; width: 100%; height: {row_height}px; background-color: #ffffff; border: {border_width} solid {border_color}; overflow: visible;">
-                                {now_line_html}
-                                <!-- Leave by label above the box -->
-                                <div style="position: absolute; left: {start_percent}%; top: -18px; font-size: 9px; color: #333; font-weight: bold; white-space: nowrap; background-color: rgba(255,255,255,0.9); padding: 0 2px; display: inline-flex; align-items: center; gap: 3px; vertical-align: middle;">
-                                    <span style="display: inline-block; vertical-align: middle; line-height: 1;">{leave_by_icon}</span>
-                                    <span>{leave_by_str}</span>
-                                </div>
-                                <!-- Arrive by label above the box -->
-                                <div style="position: absolute; left: calc({start_percent}% + {width_percent}%); top: -18px; transform: translateX(-100%); font-size: 9px; color: #333; font-weight: bold; white-space: nowrap; background-color: rgba(255,255,255,0.9); padding: 0 2px; display: inline-flex; align-items: center; gap: 3px; vertical-align: middle;">
-                                    <span style="display: inline-block; vertical-align: middle; line-height: 1;">{arrive_by_icon}</span>
-                                    <span>{arrive_by_str}</span>
-                                </div>
-                                <div style="position: absolute; left: {start_percent}%; width: {width_percent}%; height: 100%; display: flex; border-radius: 3px; overflow: visible;">
-                                    <!-- Biking before (to station) -->
-                                    <div style="width: {biking_before_percent}%; background-color: #FFC917; border-right: 1px solid #E6B815; position: relative;" title="Biking to station"></div>
-                                    <!-- Train time -->
-                                    <div style="position: relative; width: {train_percent}%; background-color: #003082; border-right: 1px solid #002366;" title="Train time">
-                                        <div style="position: absolute; left: 2px; top: 2px; font-size: 9px; color: white; font-weight: bold; white-space: nowrap; text-shadow: 1px 1px 2px rgba(0,0,0,0.5);">{dep_time_str}</div>
-                                        <div style="position: absolute; right: 2px; bottom: 2px; font-size: 9px; color: white; font-weight: bold; white-space: nowrap; text-shadow: 1px 1px 2px rgba(0,0,0,0.5);">{arr_time_str}</div>
-                                    </div>
-                                    <!-- Biking after (from station) -->
-                                    <div style="width: {biking_after_percent}%; background-color: #FFC917; position: relative;" title="Biking from station"></div>
-                                </div>
-                            </div>
-                        '''
-                        gantt_bar.set_content(gantt_html)
-
-        # Check for anchor after trips are rendered
-        await scroll_to_anchor_if_present()
+    # Page state shared by the render functions
+    page = {}
 
     # Initial load of trips
     await refresh_trips()
 
+    # The client may have gone while the trips were fetched, running its
+    # delete handlers before this page could register one
+    if ui.context.client._deleted:
+        return
+
+    # Push trip changes to this page until the client goes away
+    subscription = hub.subscribe(where, page['date_time'], on_trips_changed, version=page['trips'].version,
+                                 station_selection=station_selection)
+    ui.context.client.on_delete(lambda: hub.unsubscribe(subscription))
+
+    metrics.render_seconds.observe(time.perf_counter() - render_start, view="v3")
+    metrics.page_elements.observe(len(ui.context.client.elements), view="v3")